@@ -0,0 +1,505 @@
+#! /usr/bin/env python
+# benchmark banshee-gm.py offline against synthetic libraries
+
+# Copyright (C) 2012 David Dooling
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the
+#       names of the contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import imp
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import urllib
+from optparse import OptionParser
+
+pkg = 'banshee-gm-bench'
+__version__ = '0.1'
+
+# scenarios in the order they are run
+scenarios = ['get_b_library', 'get_b_library:warm', 'get_gm_library',
+             'get_gm_library:warm', 'diff', 'sync', 'sync:warm', 'track',
+             'track:warm', 'playlist']
+
+# words to build names from
+words = ['love', 'night', 'blue', 'dream', 'fire', 'road', 'heart', 'rain',
+         'sun', 'gold', 'city', 'river', 'star', 'home', 'wild', 'the',
+         'electric', 'black', 'white', 'summer', 'winter', 'ghost', 'young']
+
+def make_banshee_db(path, n, home, playlists=20, seed=0):
+    '''Write a synthetic Banshee database with n tracks.
+
+    :param path: name of database file to create
+    :param n: number of tracks
+    :param home: home directory the track URIs point into
+    :param playlists: number of playlists to create
+    :param seed: random number generator seed
+
+    Only the tables and columns banshee-gm.py uses are created.  About
+    one album in ten has duplicate tracks and a few percent of the
+    tracks are podcasts, pdf files, or not local.
+    '''
+
+    if os.path.exists(path):
+        os.remove(path)
+    rand = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.executescript('''
+      create table CoreArtists (ArtistID integer primary key, Name text,
+        NameLowered text);
+      create table CoreAlbums (AlbumID integer primary key, ArtistID integer,
+        Title text, TitleLowered text, ArtistName text);
+      create table CoreTracks (TrackID integer primary key, ArtistID integer,
+        AlbumID integer, Uri text, MimeType text, Title text,
+        TitleLowered text, TrackNumber integer, TrackCount integer,
+        Disc integer, DiscCount integer, Duration integer, Year integer,
+        Genre text, Composer text, Rating integer, PlayCount integer,
+        LastPlayedStamp integer, DateAddedStamp integer,
+        DateUpdatedStamp integer);
+      create table CorePlaylists (PlaylistID integer primary key, Name text);
+      create table CorePlaylistEntries (EntryID integer primary key,
+        PlaylistID integer, TrackID integer, ViewOrder integer);''')
+
+    artists = max(1, n // 60)
+    albums = max(1, n // 12)
+
+    def name(k):
+        return u' '.join(rand.choice(words).title() for i in range(k))
+
+    conn.executemany('insert into CoreArtists values (?, ?, ?)',
+                     ((a, name(2) + u' {0}'.format(a), None)
+                      for a in range(1, artists + 1)))
+    conn.executemany('insert into CoreAlbums values (?, ?, ?, ?, ?)',
+                     ((l, l % artists + 1, name(3) + u' ({0})'.format(l), None,
+                       None) for l in range(1, albums + 1)))
+
+    def title(i):
+        r = random.Random(i)
+        return u' '.join(r.choice(words).title() for k in range(2)) + \
+            u' {0}'.format(i)
+
+    def track(i):
+        album = (i - 1) // 12 + 1
+        n_track = (i - 1) % 12 + 1
+        t_title = title(i)
+        # every tenth album is a second copy of the previous one
+        if album % 10 == 0 and album > 1:
+            album -= 1
+            t_title = title(i - 12)
+        ext = rand.choice(['mp3', 'mp3', 'ogg', 'flac', 'm4a'])
+        uri = u'file://{0}/Music/Banshee/{1}/{2}/{3:02d}%20{4}.{5}'.format(
+            home, album % artists + 1, album, n_track, i, ext)
+        genre = u'Rock'
+        r = rand.random()
+        if r < 0.02:
+            genre = u'Podcast'
+        elif r < 0.03:
+            uri = uri[:-len(ext)] + u'pdf'
+        elif r < 0.04:
+            uri = u'http://example.com/stream/{0}'.format(i)
+        return (i, album % artists + 1, album, uri, None, t_title, None,
+                n_track, 12, 1, 1, rand.randint(90, 600) * 1000,
+                rand.randint(1960, 2012), genre, None,
+                rand.choice([None, 0, 2, 3, 4, 5]), rand.randint(0, 50),
+                None, 1300000000 + i, 1300000000 + i)
+
+    conn.executemany('insert into CoreTracks values ({0})'.format(
+            ','.join('?' * 20)), (track(i) for i in range(1, n + 1)))
+
+    def entries():
+        for p in range(1, playlists + 1):
+            size = rand.randint(10, 1500)
+            for v in range(size):
+                yield (p, rand.randint(1, n), v)
+
+    conn.executemany('insert into CorePlaylists values (?, ?)',
+                     ((p, u'playlist {0}'.format(p))
+                      for p in range(1, playlists + 1)))
+    conn.executemany('insert into CorePlaylistEntries (PlaylistID, TrackID, '
+                     'ViewOrder) values (?, ?, ?)', entries())
+    conn.commit()
+    conn.close()
+
+    return path
+
+class FakeApi(object):
+    '''In-process stand-in for gmusicapi.api.Api.
+
+    The library is built from a synthetic Banshee database (see
+    FakeApi.load).  Every call sleeps for latency seconds and raises
+    IOError with probability failure_rate.  Calls are counted by
+    method name in FakeApi.calls.
+    '''
+
+    latency = 0.0
+    failure_rate = 0.0
+    songs = []
+    playlists = {}
+    calls = {}
+    lock = threading.Lock()
+
+    @classmethod
+    def load(cls, banshee_db, fraction=0.9, seed=0):
+        '''Fill the fake library with a fraction of the Banshee tracks.'''
+
+        rand = random.Random(seed)
+        conn = sqlite3.connect(banshee_db)
+        cls.songs = []
+        for row in conn.execute('''
+          select t.TrackID, t.Title, t.TrackNumber, t.Duration, t.PlayCount,
+            t.Year, a.Name, l.Title
+          from CoreTracks as t
+            join CoreArtists as a on t.ArtistID = a.ArtistID
+            join CoreAlbums as l on t.AlbumID = l.AlbumID'''):
+            if rand.random() > fraction:
+                continue
+            (i, title, n, duration, count, year, artist, album) = row
+            cls.songs.append({
+                    'id': u'song-{0}'.format(i), 'title': title,
+                    'track': n, 'durationMillis': unicode(duration),
+                    'playCount': count // 2, 'year': year, 'artist': artist,
+                    'album': album, 'albumArtist': u'', 'composer': u'',
+                    'genre': u'', 'rating': 0, 'disc': 1, 'totalDiscs': 0,
+                    'totalTracks': 0,
+                    'lastModifiedTimestamp': unicode(1300000000000000 + i)})
+        conn.close()
+        cls.playlists = {}
+
+    def call(self, name):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise IOError('simulated failure in {0}'.format(name))
+
+    def login(self, email, password):
+        self.call('login')
+        return True
+
+    def is_authenticated(self):
+        return True
+
+    def logout(self):
+        self.call('logout')
+        return True
+
+    def get_all_songs(self, incremental=False, updated_after=None,
+                      include_deleted=None):
+        self.call('get_all_songs')
+        if updated_after is not None:
+            return []
+        return [dict(t) for t in self.songs]
+
+    def get_all_playlist_ids(self, auto=True, user=True, always_id_lists=False):
+        self.call('get_all_playlist_ids')
+        return {'auto': {}, 'user': dict((p['name'], [i]) for (i, p)
+                                         in self.playlists.iteritems())}
+
+    def get_playlist_songs(self, playlist_id):
+        self.call('get_playlist_songs')
+        return [dict(t) for t in self.playlists[playlist_id]['songs']]
+
+    def create_playlist(self, name):
+        self.call('create_playlist')
+        with self.lock:
+            pl_id = u'playlist-{0}'.format(len(self.playlists))
+            self.playlists[pl_id] = {'name': name, 'songs': []}
+        return pl_id
+
+    def add_songs_to_playlist(self, playlist_id, song_ids):
+        self.call('add_songs_to_playlist')
+        if not isinstance(song_ids, list):
+            song_ids = [song_ids]
+        entries = []
+        for song_id in song_ids:
+            entry_id = u'entry-{0}'.format(random.random())
+            self.playlists[playlist_id]['songs'].append(
+                {'id': song_id, 'playlistEntryId': entry_id, 'title': u'',
+                 'album': u'', 'artist': u''})
+            entries.append((song_id, entry_id))
+        return entries
+
+    def change_song_metadata(self, songs):
+        self.call('change_song_metadata')
+        if not isinstance(songs, list):
+            songs = [songs]
+        return [t['id'] for t in songs]
+
+    def delete_songs(self, song_ids):
+        self.call('delete_songs')
+        if not isinstance(song_ids, list):
+            song_ids = [song_ids]
+        return song_ids
+
+def load_banshee_gm(script):
+    '''Import banshee-gm.py with FakeApi standing in for gmusicapi.
+
+    :param script: path to banshee-gm.py
+    '''
+
+    gmusicapi = types.ModuleType('gmusicapi')
+    api = types.ModuleType('gmusicapi.api')
+    api.Api = FakeApi
+    gmusicapi.api = api
+    sys.modules['gmusicapi'] = gmusicapi
+    sys.modules['gmusicapi.api'] = api
+    return imp.load_source('banshee_gm', script)
+
+def make_music_files(banshee_db):
+    '''Create empty files for the local tracks in a Banshee database.'''
+
+    conn = sqlite3.connect(banshee_db)
+    made = set()
+    for (uri,) in conn.execute("select Uri from CoreTracks "
+                               "where Uri like 'file://%'"):
+        path = urllib.unquote(uri[7:].encode('utf-8'))
+        d = os.path.dirname(path)
+        if d not in made:
+            if not os.path.isdir(d):
+                os.makedirs(d)
+            made.add(d)
+        open(path, 'a').close()
+    conn.close()
+
+def run_scenario(script, scenario, banshee_db, home, work, options, pipe):
+    '''Run one scenario and send its measurements through pipe.
+
+    This runs in a child process so the peak RSS belongs to the
+    scenario (including loading the libraries it needs).
+    '''
+
+    os.environ['HOME'] = home
+    os.chdir(work)
+    FakeApi.latency = options.latency
+    FakeApi.failure_rate = options.failure_rate
+    FakeApi.load(banshee_db)
+    bgm = load_banshee_gm(script)
+    bgm.logmsg.quiet = True
+    bgm.logmsg.log_f = open(os.devnull, 'w')
+    bgm.jobs = options.jobs
+    bgm.shards = options.shards
+    api = FakeApi()
+    conn = sqlite3.connect(banshee_db)
+    executor = bgm.MutationExecutor(options.rate, options.concurrency,
+                                    batch_size=options.batch_size)
+
+    (name, variant) = (scenario.split(':') + [None])[:2]
+    # warm runs start from the state a previous run left behind
+    if variant == 'warm':
+        if name == 'get_b_library':
+            bgm.get_b_library(conn, 3)
+        elif name == 'get_gm_library':
+            bgm.get_gm_library(api)
+
+    # load whatever the scenario needs before timing starts
+    gm_tracks = b_tracks = b_playlists = None
+    if name in ('diff', 'track', 'playlist'):
+        gm_tracks = bgm.get_gm_library(api, None)
+    if name in ('diff', 'sync', 'track', 'playlist'):
+        b_tracks = bgm.get_b_library(conn, 3, True)
+    if name == 'playlist':
+        b_playlists = bgm.get_b_playlists(conn)
+    if name == 'get_gm_library':
+        snapshot = bgm.load_snapshot(bgm.gm_snapshot_file)
+    # a warm sync follows one that staged everything
+    if scenario == 'sync:warm':
+        bgm.sync(b_tracks)
+    # a warm track run follows one that pushed everything
+    if scenario == 'track:warm':
+        if hasattr(bgm, 'ledger'):
+            bgm.ledger.filename = bgm.push_ledger_file
+        bgm.track(api, gm_tracks, b_tracks, ['rating', 'playCount:sum'],
+                  executor)
+
+    FakeApi.calls.clear()
+    start = time.time()
+    if name == 'get_b_library':
+        bgm.get_b_library(conn, 3)
+    elif name == 'get_gm_library':
+        bgm.get_gm_library(api, snapshot)
+    elif name == 'diff':
+        bgm.diff(gm_tracks, b_tracks)
+    elif name == 'sync':
+        bgm.sync(b_tracks)
+    elif name == 'track':
+        bgm.track(api, gm_tracks, b_tracks, ['rating', 'playCount:sum'],
+                  executor)
+    elif name == 'playlist':
+        bgm.playlist(api, gm_tracks, b_playlists, executor)
+    wall = time.time() - start
+
+    pipe.send({'wall': wall,
+               'peak_rss_kb': resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss,
+               'calls': dict(FakeApi.calls)})
+    pipe.close()
+
+def revision(script):
+    '''Return git revision of script, or "unknown".'''
+
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(script))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def compare(old_file, new_file):
+    '''Print wall time and peak RSS of two result files side by side.'''
+
+    def read(filename):
+        results = {}
+        with open(filename) as f:
+            for line in f:
+                r = json.loads(line)
+                results[(r['tracks'], r['scenario'])] = r
+        return results
+
+    old = read(old_file)
+    new = read(new_file)
+    print '{0:>8} {1:<22} {2:>10} {3:>10} {4:>7} {5:>10} {6:>10}'.format(
+        'tracks', 'scenario', 'old s', 'new s', 'ratio', 'old MB', 'new MB')
+    for k in sorted(set(old) & set(new)):
+        (o, n) = (old[k], new[k])
+        ratio = o['wall'] / n['wall'] if n['wall'] else float('inf')
+        print '{0:>8} {1:<22} {2:>10.3f} {3:>10.3f} {4:>6.2f}x {5:>10.1f} {6:>10.1f}'.format(
+            k[0], k[1], o['wall'], n['wall'], ratio, o['peak_rss_kb'] / 1024.0,
+            n['peak_rss_kb'] / 1024.0)
+
+def main(argv):
+    '''Generate libraries, run scenarios, and record results.
+
+    :param argv: list of command line arguments
+    '''
+
+    usage = """%prog [OPTIONS]... [SCENARIO]...
+       %prog --compare OLD_RESULTS NEW_RESULTS
+
+scenarios: {0}""".format(', '.join(scenarios))
+    version_str = "{0} {1}".format(pkg, __version__)
+    parser = OptionParser(usage=usage, version=version_str)
+    script_def = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'banshee-gm.py')
+    parser.add_option("--script", default=script_def,
+                      help="banshee-gm.py to benchmark (default {0})".format(
+            script_def))
+    parser.add_option("-s", "--sizes", default="10000",
+                      help="comma separated numbers of tracks (default 10000)")
+    parser.add_option("-o", "--output", default="bench.results",
+                      help="append results to OUTPUT (default bench.results)")
+    parser.add_option("-w", "--work-dir",
+                      help="keep generated libraries in WORK_DIR")
+    parser.add_option("--latency", type="float", default=0.0,
+                      help="seconds each fake api call takes (default 0)")
+    parser.add_option("--failure-rate", type="float", default=0.0,
+                      help="fraction of fake api calls that fail (default 0)")
+    parser.add_option("--rate", type="float", default=1000.0,
+                      help="google music calls per second (default 1000)")
+    parser.add_option("-c", "--concurrency", type="int", default=1,
+                      help="concurrent google music calls (default 1)")
+    parser.add_option("--batch-size", type="int", default=25,
+                      help="songs per google music call (default 25)")
+    parser.add_option("-j", "--jobs", type="int", default=1,
+                      help="threads for file system work (default 1)")
+    parser.add_option("--shards", type="int", default=1,
+                      help="processes comparing tracks (default 1)")
+    parser.add_option("--compare", action="store_true", default=False,
+                      help="compare two result files")
+    (options, args) = parser.parse_args(argv[1:])
+
+    if options.compare:
+        if len(args) != 2:
+            parser.error('--compare needs two result files')
+        compare(args[0], args[1])
+        return 0
+
+    run = args or scenarios
+    for s in run:
+        if s not in scenarios:
+            parser.error('unknown scenario: {0}'.format(s))
+
+    work_root = options.work_dir or tempfile.mkdtemp(prefix=pkg + '-')
+    rev = revision(options.script)
+    with open(options.output, 'a') as out:
+        for n in [int(x) for x in options.sizes.split(',')]:
+            home = os.path.join(os.path.abspath(work_root), 'home-{0}'.format(n))
+            banshee_db = os.path.join(home, 'banshee.db')
+            if not os.path.exists(banshee_db):
+                if not os.path.isdir(home):
+                    os.makedirs(home)
+                print '{0}: generating {1} tracks'.format(pkg, n)
+                make_banshee_db(banshee_db, n, home)
+            if 'sync' in run and not os.path.isdir(home + '/Music/Banshee'):
+                print '{0}: creating music files'.format(pkg)
+                make_music_files(banshee_db)
+
+            for s in run:
+                # every scenario starts from a clean working directory
+                work = os.path.join(home, 'work')
+                if os.path.isdir(work):
+                    shutil.rmtree(work)
+                os.makedirs(work)
+                staging = home + '/Music/GoogleMusic'
+                if os.path.isdir(staging):
+                    shutil.rmtree(staging)
+
+                (parent, child) = multiprocessing.Pipe()
+                p = multiprocessing.Process(
+                    target=run_scenario, args=(options.script, s, banshee_db,
+                                               home, work, options, child))
+                p.start()
+                child.close()
+                try:
+                    result = parent.recv()
+                except EOFError:
+                    result = None
+                p.join()
+                if p.exitcode or result is None:
+                    print '{0}: scenario failed: {1}'.format(pkg, s)
+                    continue
+
+                result.update({'revision': rev, 'scenario': s, 'tracks': n,
+                               'time': time.time()})
+                out.write(json.dumps(result, sort_keys=True) + '\n')
+                out.flush()
+                print '{0}: {1} {2}: {3:.3f}s, {4:.1f} MB'.format(
+                    pkg, n, s, result['wall'], result['peak_rss_kb'] / 1024.0)
+
+    if not options.work_dir:
+        shutil.rmtree(work_root)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
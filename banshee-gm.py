@@ -26,19 +26,54 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import ConfigParser
+import atexit
 import codecs
+import cPickle
+import cProfile
+import difflib
+import errno
+import functools
+import gc
+import hashlib
+import io
+import json
+import marshal
+import math
+import multiprocessing
+import operator
 import os
+import pstats
 import pprint
 import re
+import shlex
+import shutil
+import signal
 import sqlite3
+import stat
+import subprocess
 import sys
+import threading
 import time
 import urllib
+from Queue import Empty, Queue
+from StringIO import StringIO
+from contextlib import contextmanager
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
 from distutils.dir_util import mkpath
 # https://github.com/simon-weber/Unofficial-Google-Music-API
 from gmusicapi.api import Api
 from getpass import getpass
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # https://github.com/benhoyt/scandir
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 # setup stdout and stderr for utf-8
 reload(sys)
@@ -54,37 +89,621 @@ __version__ = '0.7'
 # have been done (see --dry-run command line option)
 dryrun = False
 
-def logmsg(msg, error=False):
+# number of threads to use for file system work (see --jobs)
+jobs = 1
+
+# number of processes to reconcile tracks with (see --shards), fewer
+# than shard_min_rows tracks are always reconciled in one process
+shards = 1
+shard_min_rows = 20000
+
+# directory holding the Banshee and GoogleMusic directories, None for
+# ~/Music (see --music-root)
+music_root = None
+
+# environment variable holding the google password
+password_env = 'BANSHEE_GM_PASSWORD'
+
+# database holding the keys reported by each run
+report_db_file = 'banshee-gm-report.db'
+
+# database holding the Banshee values last pushed to each song
+push_ledger_file = 'banshee-gm-ledger.db'
+# ledger value holding the google music play count a sum pushed
+ledger_gm_total = 'gm.playCount'
+
+# file holding the local copy of the google music library
+gm_snapshot_file = 'gm.snapshot'
+# bump when the layout of snapshot files changes
+snapshot_version = 4
+
+# log message levels
+log_levels = {'debug': 10, 'info': 20, 'error': 40}
+
+# categories of per-track messages whose level can be set separately
+log_categories = ['link', 'prune', 'track', 'playlist', 'delete']
+
+def logmsg(msg, error=False, category=None):
     """Print status messages and write to log file.
 
     :param msg: text of message to record
     :param error: set to True if it is an error message
+    :param category: category of message (see log_categories)
+
+    Messages are dropped when the level set for their category (or
+    the default level) is above info.  Error messages are always
+    recorded.
     """
 
+    if not error:
+        level = logmsg.levels.get(category, logmsg.levels[None])
+        if level > log_levels['info']:
+            return
     text = u"{0}: {1}".format(pkg, msg)
     if not logmsg.quiet:
         if error:
             sys.stderr.write(text + u'\n')
         else:
-            print text 
-    logmsg.log_f.write(u"{0}\n".format(msg))
+            print text
+    if logmsg.log_f:
+        logmsg.log_f.write(u"{0}\n".format(msg))
     return
 
-def write_keys(filename, d):
-    '''Write sorted keys from dictionary in filename.
+# defaults until main sets them up
+logmsg.quiet = False
+logmsg.levels = {None: log_levels['info']}
+logmsg.log_f = None
+
+class LogWriter(object):
+    '''Buffered log file written by a background thread.
+
+    :param filename: name of log file
+    :param interval: flush the file after this many idle seconds
+
+    write() only queues the text, so the caller never waits for the
+    disk.  close() writes everything still queued and closes the file;
+    it is safe to call more than once.
+    '''
+
+    def __init__(self, filename, interval=1.0):
+        self.f = io.open(filename, mode='w', encoding='utf-8',
+                         buffering=1 << 16)
+        self.interval = interval
+        self.queue = Queue()
+        self.thread = threading.Thread(target=self.run, name='log-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, text):
+        '''Queue text to be written to the log file.'''
+        self.queue.put(text)
+
+    def run(self):
+        '''Write queued text until close() is called.'''
+
+        while True:
+            try:
+                text = self.queue.get(timeout=self.interval)
+            except Empty:
+                self.f.flush()
+                continue
+            # write everything that is queued at once
+            lines = []
+            while text is not None:
+                lines.append(unicode(text))
+                try:
+                    text = self.queue.get_nowait()
+                except Empty:
+                    break
+            self.f.write(u''.join(lines))
+            if text is None:
+                break
+        self.f.close()
+
+    def close(self):
+        '''Write out queued text and close the log file.'''
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+class Metrics(object):
+    '''Collect phase timings, counters, and latency histograms for a run.
+
+    Spans are timed with the span() context manager and may nest, also
+    in worker threads.  Latencies are kept in histograms with power of
+    two microsecond buckets.  Everything is written as JSON by write().
+    '''
+
+    def __init__(self):
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.spans = []
+        self.counters = {}
+        self.latencies = {}
+        self.info = {}
+
+    @contextmanager
+    def span(self, name):
+        '''Time the enclosed block as a span called name.'''
+
+        depth = getattr(self.local, 'depth', 0)
+        self.local.depth = depth + 1
+        start = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - start
+            self.local.depth = depth
+            with self.lock:
+                self.spans.append({'name': name, 'depth': depth,
+                                   'thread': threading.current_thread().name,
+                                   'start': start - self.start,
+                                   'duration': duration})
+
+    def count(self, name, n=1):
+        '''Add n to counter name.'''
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, seconds):
+        '''Count an event called name and record how long it took.'''
+
+        us = max(1, int(seconds * 1e6))
+        bucket = str(2 ** int(math.ceil(math.log(us, 2))))
+        with self.lock:
+            h = self.latencies.get(name)
+            if h is None:
+                h = self.latencies[name] = {'count': 0, 'total': 0.0,
+                                            'max': 0.0, 'buckets_us': {}}
+            h['count'] += 1
+            h['total'] += seconds
+            h['max'] = max(h['max'], seconds)
+            h['buckets_us'][bucket] = h['buckets_us'].get(bucket, 0) + 1
+
+    def timed(self, name, func):
+        '''Return wrapper of func recording its latency under name.
+
+        Calls made while another timed call is running in the same
+        thread (say, the lstat calls inside realpath) are not recorded.
+        '''
+
+        local = self.local
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if getattr(local, 'timing', False):
+                return func(*args, **kwargs)
+            local.timing = True
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                local.timing = False
+                self.observe(name, time.time() - start)
+        return wrapper
+
+    def write(self, filename):
+        '''Write collected metrics to filename as JSON.'''
+
+        hits, misses = normalizer.stats()
+        self.counters['normalizer.hits'] = hits
+        self.counters['normalizer.misses'] = misses
+        hits, misses = path_cache.stats()
+        self.counters['path_cache.hits'] = hits
+        self.counters['path_cache.misses'] = misses
+        with self.lock:
+            doc = {'info': self.info, 'start': self.start,
+                   'wall': time.time() - self.start, 'spans': self.spans,
+                   'counters': self.counters, 'latency': self.latencies}
+        try:
+            with open(filename, 'w') as f:
+                json.dump(doc, f, indent=1, sort_keys=True)
+        except IOError as e:
+            sys.stderr.write('{0}: unable to write metrics: {1}\n'.format(
+                    pkg, e))
+
+# metrics of this run
+metrics = Metrics()
+
+class InstrumentedApi(object):
+    '''Wrap a Google Music API connection, timing every method call.
+
+    :param api: Google Music API connection
+    '''
+
+    def __init__(self, api):
+        self._api = api
+
+    def __getattr__(self, name):
+        attr = getattr(self._api, name)
+        if not callable(attr):
+            return attr
+        wrapper = metrics.timed('api.' + name, attr)
+        # cache so later lookups do not wrap again
+        setattr(self, name, wrapper)
+        return wrapper
+
+def instrument_syscalls():
+    '''Replace file system functions with versions recording latency.'''
+
+    global scandir, mkpath
+    for (mod, names) in ((os, ['link', 'unlink', 'rmdir', 'listdir', 'lstat']),
+                         (os.path, ['realpath', 'exists', 'isdir'])):
+        for name in names:
+            setattr(mod, name, metrics.timed('fs.' + name, getattr(mod, name)))
+    if scandir is not None:
+        scandir = metrics.timed('fs.scandir', scandir)
+    mkpath = metrics.timed('fs.mkpath', mkpath)
+
+def start_profiling(profile, trace_malloc):
+    '''Start cProfile and/or tracemalloc, reporting at exit.
+
+    :param profile: if True, profile with cProfile
+    :param trace_malloc: if True, trace allocations with tracemalloc
+
+    The 25 functions with the highest cumulative time are logged and
+    the full profile is saved in banshee-gm.prof.  The 25 source lines
+    allocating the most memory are logged.
+    '''
+
+    if profile:
+        profiler = cProfile.Profile()
+
+        def report_profile():
+            profiler.disable()
+            profiler.dump_stats(pkg + '.prof')
+            out = StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats(
+                'cumulative').print_stats(25)
+            logmsg(u'profile:\n{0}'.format(out.getvalue()))
+
+        atexit.register(report_profile)
+        profiler.enable()
+
+    if trace_malloc:
+        try:
+            import tracemalloc
+        except ImportError:
+            logmsg('tracemalloc is not available', True)
+            return
+
+        def report_malloc():
+            top = tracemalloc.take_snapshot().statistics('lineno')[:25]
+            logmsg(u'top allocations:\n{0}'.format(
+                    u'\n'.join(unicode(stat) for stat in top)))
+
+        atexit.register(report_malloc)
+        tracemalloc.start()
+
+class RunReport(object):
+    '''Keys reported by runs, kept in a SQLite database.
+
+    Each run gets a row in the runs table.  Every report (gm.dup,
+    b-gm.up, ...) of the run is a category, recorded with the number
+    of its keys in the categories table and with one row per key in
+    the keys table.  Reports are collected in memory and written in a
+    single transaction by save().
+
+    Until a database file is set, reports are written to flat files
+    named after the category, as they always were.
+    '''
+
+    schema = (
+        '''create table if not exists runs (
+               id integer primary key,
+               time real,
+               command text,
+               args text)''',
+        '''create table if not exists categories (
+               run integer,
+               category text,
+               count integer,
+               primary key (run, category))''',
+        '''create table if not exists keys (
+               run integer,
+               category text,
+               key text,
+               primary key (run, category, key))''',
+        )
+
+    def __init__(self):
+        self.filename = None
+        self.flat = True
+        self.reports = {}
+
+    def connect(self):
+        '''Return a connection to the database, creating its tables.'''
+        conn = sqlite3.connect(self.filename)
+        with conn:
+            for sql in self.schema:
+                conn.execute(sql)
+        return conn
+
+    def add(self, category, d):
+        '''Record the keys of dictionary d under category.
+
+        Byte string keys (file system paths, say) are decoded with the
+        file system encoding, since sqlite3 refuses byte strings that
+        are not ASCII.  Bytes that do not decode are replaced.
+        '''
+
+        encoding = sys.getfilesystemencoding() or 'utf-8'
+        self.reports[category] = [
+            k.decode(encoding, 'replace') if isinstance(k, str) else k
+            for k in d]
+        if self.flat:
+            write_flat_keys(category, self.reports[category])
+
+    def save(self, command, args):
+        '''Write the recorded reports as a new run.
+
+        :param command: command of this run
+        :param args: arguments of command
+        :returns: id of the new run or None if nothing was recorded
+        '''
+
+        if not self.filename or not self.reports:
+            return None
+        conn = self.connect()
+        try:
+            with conn:
+                cur = conn.execute(
+                    'insert into runs (time, command, args) values (?, ?, ?)',
+                    (time.time(), command, json.dumps(args)))
+                run = cur.lastrowid
+                conn.executemany(
+                    'insert into categories values (?, ?, ?)',
+                    ((run, c, len(keys))
+                     for (c, keys) in self.reports.iteritems()))
+                # keys whose bad bytes were replaced may coincide
+                conn.executemany(
+                    'insert or ignore into keys values (?, ?, ?)',
+                    ((run, c, k)
+                     for (c, keys) in self.reports.iteritems() for k in keys))
+        finally:
+            conn.close()
+        self.reports = {}
+        return run
+
+# reports of this run
+report = RunReport()
+
+class PushLedger(object):
+    '''Banshee values last pushed to each Google Music song.
+
+    The pushed table has a row for every song the track command
+    brought up to date, holding the song id, a hash of the update
+    elements and Banshee values of the last push (see
+    track_push_hasher), and the Banshee values pushed (as JSON).  The
+    values of play counts are what later sums are taken from; summed
+    pushes also keep the Google Music play count they set under
+    ledger_gm_total.
+
+    Until a database file is set, nothing is remembered.
+    '''
+
+    schema = (
+        '''create table if not exists pushed (
+               id text primary key,
+               hash text,
+               vals text)''',
+        )
+
+    def __init__(self):
+        self.filename = None
+
+    def connect(self):
+        '''Return a connection to the database, creating its tables.'''
+        conn = sqlite3.connect(self.filename)
+        with conn:
+            for sql in self.schema:
+                conn.execute(sql)
+        return conn
+
+    def load(self):
+        '''Return dictionary of song id and (hash, values) tuples.'''
+
+        if not self.filename or not os.path.exists(self.filename):
+            return {}
+        conn = self.connect()
+        try:
+            return dict((i, (h, json.loads(v))) for (i, h, v)
+                        in conn.execute('select id, hash, vals from pushed'))
+        finally:
+            conn.close()
+
+    def record(self, entries):
+        '''Remember pushes given as (song id, hash, values) tuples.'''
+
+        if not self.filename or not entries or dryrun:
+            return
+        conn = self.connect()
+        try:
+            with conn:
+                conn.executemany(
+                    'insert or replace into pushed values (?, ?, ?)',
+                    ((i, h, json.dumps(v)) for (i, h, v) in entries))
+        finally:
+            conn.close()
+
+# pushes made by this and earlier runs
+ledger = PushLedger()
+
+def write_flat_keys(filename, keys):
+    '''Write sorted keys in filename.
 
     :param filename: name of file to write to
-    :param d: dictionary with keys to be written
+    :param keys: iterable of keys to be written
     '''
 
+    keys = sorted(keys)
     # make sure there is something to write
-    if d:
+    if keys:
         with codecs.open(filename, mode='w', encoding='utf-8') as f:
-            for k in sorted(d.keys()):
+            for k in keys:
                 f.write(k + '\n')
 
     return
 
+def write_keys(filename, d):
+    '''Record the keys from dictionary in the run report.
+
+    :param filename: name of report (and of its flat file)
+    :param d: dictionary with keys to be written
+    '''
+
+    report.add(filename, d)
+    return
+
+class LRUCache(object):
+    '''Bounded dictionary that discards the least recently used entries.
+
+    :param size: maximum number of entries to hold
+
+    Entries are kept in a circular doubly linked list so that both
+    hits and evictions are constant time.
+    '''
+
+    def __init__(self, size=65536):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.clear()
+
+    def clear(self):
+        '''Remove all entries from the cache.'''
+        self.map = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+
+    def get(self, key, default=None):
+        '''Return cached value for key (and mark it as recently used).'''
+        link = self.map.get(key)
+        if link is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        # move link to the front of the list
+        (prev, nxt) = (link[0], link[1])
+        prev[1] = nxt
+        nxt[0] = prev
+        root = self.root
+        last = root[0]
+        last[1] = root[0] = link
+        link[0] = last
+        link[1] = root
+        return link[3]
+
+    def put(self, key, value):
+        '''Store value for key, evicting the oldest entry if full.'''
+        root = self.root
+        if len(self.map) >= self.size:
+            # reuse the oldest link for the new entry
+            oldest = root[1]
+            self.map.pop(oldest[2], None)
+            root[1] = oldest[1]
+            oldest[1][0] = root
+        last = root[0]
+        link = [last, root, key, value]
+        last[1] = root[0] = self.map[key] = link
+        return value
+
+    def __len__(self):
+        return len(self.map)
+
+class _NonwordTable(dict):
+    '''Translation table deleting characters outside ASCII [\\w\\s].
+
+    This mirrors the regular expression '[^\\w\\s]' without the
+    re.UNICODE flag, so non-ASCII characters are removed as well.
+    Results for characters not yet seen are filled in on demand.
+    '''
+
+    keep = frozenset(u'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+                     u'0123456789_ \t\n\r\f\v')
+
+    def __missing__(self, c):
+        v = c if unichr(c) in self.keep else None
+        self[c] = v
+        return v
+
+class TrackKeyNormalizer(object):
+    '''Create track keys, caching the cleaned version of each field.
+
+    :param cache_size: maximum number of cached values per field
+
+    The track number, title, album, and artist each get their own
+    bounded LRU cache since artist and album strings repeat heavily
+    across a library.  The keys are identical to those make_track_key
+    has always produced.
+    '''
+
+    # compiled once and shared by all instances
+    re_paren = re.compile('[[(][^)\]]*[)\]]')
+    nonword_table = _NonwordTable()
+
+    def __init__(self, cache_size=65536):
+        self.caches = [LRUCache(cache_size) for i in range(4)]
+
+    def clean(self, item):
+        '''Return cleaned version of a single track key field.
+
+        :param item: field value (converted to unicode)
+        '''
+
+        # cast to unicode and lower case
+        item = unicode(item).lower()
+        # remove parenthetical comments
+        if u'(' in item or u'[' in item:
+            item = self.re_paren.sub(u'', item)
+        # remove nonword junk
+        item = item.translate(self.nonword_table)
+        # deal with leading, trailing, and multiple spaces
+        item = u' '.join(item.split())
+        # remove leading the
+        if item.startswith(u'the '):
+            item = item[4:]
+        return item
+
+    def field(self, i, item):
+        '''Return cleaned field, consulting the cache for field i.
+
+        :param i: index of field (0 number, 1 title, 2 album, 3 artist)
+        :param item: field value
+        '''
+
+        # cache on the unicode value so 1 and 1.0 do not collide
+        item = unicode(item)
+        cache = self.caches[i]
+        v = cache.get(item)
+        if v is None:
+            v = cache.put(item, self.clean(item))
+        return v
+
+    def key(self, n, title, album, artist):
+        '''Return track key for the provided track information.'''
+        field = self.field
+        return u'|'.join((field(0, n), field(1, title), field(2, album),
+                          field(3, artist)))
+
+    def keys(self, rows):
+        '''Return list of track keys for a sequence of rows.
+
+        :param rows: iterable of (number, title, album, artist) sequences
+        '''
+        key = self.key
+        return [key(n, title, album, artist)
+                for (n, title, album, artist) in rows]
+
+    def stats(self):
+        '''Return (hits, misses) summed across the field caches.'''
+        return (sum(c.hits for c in self.caches),
+                sum(c.misses for c in self.caches))
+
+# normalizer shared by all track key generation
+normalizer = TrackKeyNormalizer()
+
 def make_track_key(n, title, album, artist):
     """Create dictionary key from track information.
 
@@ -96,41 +715,247 @@ def make_track_key(n, title, album, artist):
     This method creates a string from the arguments after some
     cleaning, allowing for fuzzy matching of tracks while doing its
     level best to prevent false duplicates.  The key as a unicode
-    string is returned.
+    string is returned.  See TrackKeyNormalizer for the details.
     """
 
-    # compile regular expression
-    re_paren = re.compile('[[(][^)\]]*[)\]]')
-    re_nonword = re.compile('[^\w\s]')
-    re_mspace = re.compile('\s+')
-    re_prespace = re.compile('^\s+')
-    re_postspace = re.compile('\s+$')
-    re_the = re.compile('^the\s+', re.I)
-
-    # create dictionary key
-    key_items = []
-    for item in [n, title, album, artist]:
-        # cast to unicode
-        item = unicode(item)
-        # lower case
-        item = item.lower()
-        # remove parenthetical comments
-        item = re_paren.sub('', item)
-        # remove nonword junk
-        item = re_nonword.sub('', item)
-        # deal with leading, trailing, and multiple spaces
-        item = re_mspace.sub(' ', item)
-        item = re_prespace.sub('', item)
-        item = re_postspace.sub('', item)
-        # remove leading the
-        item = re_the.sub('', item)
+    return normalizer.key(n, title, album, artist)
+
+def gc_paused(func):
+    '''Return wrapper of func running it with garbage collection paused.
 
-        # add to list
-        key_items.append(item)
+    This is meant for functions creating many long lived objects
+    without reference cycles, say, an object for every track, since
+    the collections they set off go through the whole heap only to
+    find nothing to free.
+    '''
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if enabled:
+                gc.enable()
+    return wrapper
 
-    key = '|'.join(key_items)
+def shard_worker(task):
+    '''Run the function of one shard of shard_map in a pool process.
 
-    return key
+    :param task: tuple of the function, its marshaled rows, and its
+                 other arguments
+
+    The result is returned marshaled as well.  Garbage collection is
+    turned off, since collections would also go through all the
+    objects inherited from the parent (see gc_paused).
+    '''
+
+    gc.disable()
+    (func, blob, args) = task
+    return marshal.dumps(func(marshal.loads(blob), *args))
+
+def shard_map(func, rows, shard_by, *args):
+    '''Apply func to rows split into shards run by a pool of processes.
+
+    :param func: module level function taking a list of rows and args
+    :param rows: list of rows of plain values (see the marshal module)
+    :param shard_by: function returning the value a row is sharded on
+    :param args: other arguments of func
+
+    Rows whose shard_by values are equal end up in the same shard, in
+    their original order, so func can compare them with each other.
+    Rows and results travel to and from the shards marshaled, which
+    is several times faster than pickling them.  A list of
+    (positions, result) tuples is returned, one per shard, positions
+    being the indexes in rows of the rows in the shard.  If shards is
+    less than two, there are fewer than shard_min_rows rows, or the
+    rows cannot be marshaled, func is applied to all the rows in this
+    process and positions is None.
+    '''
+
+    parts = None
+    if shards > 1 and len(rows) >= shard_min_rows:
+        parts = [[] for i in range(shards)]
+        for (i, row) in enumerate(rows):
+            parts[hash(shard_by(row)) % shards].append(i)
+        try:
+            blobs = [marshal.dumps([rows[i] for i in part]) for part in parts]
+        except ValueError:
+            parts = None
+    if parts is None:
+        return [(None, func(rows, *args))]
+
+    pool = multiprocessing.Pool(shards)
+    try:
+        results = pool.map(shard_worker, [(func, blob, args) for blob in blobs],
+                           1)
+    finally:
+        pool.terminate()
+        pool.join()
+    return [(part, marshal.loads(result))
+            for (part, result) in zip(parts, results)]
+
+def track_keys(rows):
+    '''Return list of track keys of a list of rows (see make_track_keys).'''
+    return normalizer.keys(rows)
+
+def make_track_keys(rows):
+    '''Create the track keys of many tracks at once.
+
+    :param rows: list of (number, title, album, artist) tuples
+
+    The rows are sharded on artist (see shard_map), so the fields an
+    artist's tracks share are only cleaned in one process.  A list of
+    the keys, in the order of the rows, is returned.
+    '''
+
+    results = shard_map(track_keys, rows, lambda row: row[3])
+    if results[0][0] is None:
+        return results[0][1]
+    keys = [None] * len(rows)
+    for (part, part_keys) in results:
+        for (i, key) in zip(part, part_keys):
+            keys[i] = key
+    return keys
+
+# shared copies of strings repeated across tracks (the intern builtin
+# only accepts byte strings)
+shared_strings = {}
+
+class TrackRecord(tuple):
+    '''Compact, read-only song record holding a fixed set of fields.
+
+    :param song: song dictionary (fields not kept are dropped) or a
+                 sequence of values in the order of the fields
+    :param ready: if True, song holds the values of a record as they
+                  were stored (see save_snapshot)
+
+    Subclasses list the fields they keep in fields.  Records stand in
+    for song dictionaries: fields are read with t['field'],
+    t.get('field'), and iteritems(), and to_dict() returns the plain
+    dictionary form, e.g. for change_song_metadata.  Fields the song
+    does not have hold None; they read as None but are left out of
+    "in", iteritems(), and to_dict(), as they would be from a
+    dictionary.  Strings of the shared fields are shared between
+    records through shared_strings.  Subclasses set up their fields
+    with define().
+    '''
+
+    __slots__ = ()
+
+    def __new__(cls, song=(), ready=False):
+        if ready:
+            # defaults and shared strings were taken care of already
+            return tuple.__new__(cls, song)
+        if isinstance(song, dict):
+            values = [song.get(f) for f in cls.fields]
+        else:
+            values = list(song)
+        for (i, value) in cls.default_values:
+            if values[i] is None:
+                values[i] = value
+        share = shared_strings.setdefault
+        for i in cls.shared:
+            if values[i] is not None:
+                values[i] = share(values[i], values[i])
+        return tuple.__new__(cls, values)
+
+    def __getnewargs__(self):
+        return (tuple(tuple.__iter__(self)), True)
+
+    def __getitem__(self, field):
+        return tuple.__getitem__(self, self.index[field])
+
+    def __contains__(self, field):
+        i = self.index.get(field)
+        return i is not None and tuple.__getitem__(self, i) is not None
+
+    def get(self, field, default=None):
+        i = self.index.get(field)
+        if i is None or tuple.__getitem__(self, i) is None:
+            return default
+        return tuple.__getitem__(self, i)
+
+    def iteritems(self):
+        for (field, value) in zip(self.fields, tuple.__iter__(self)):
+            if value is not None:
+                yield (field, value)
+
+    def keys(self):
+        return [field for (field, value) in self.iteritems()]
+
+    def to_dict(self):
+        '''Return the record as a song dictionary.'''
+        return dict(self.iteritems())
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(type(self).__name__, self.to_dict())
+
+    @classmethod
+    def getter(cls, fields):
+        '''Return function returning values of a record as a plain tuple.
+
+        :param fields: names of the fields to return, in order
+        '''
+
+        get = operator.itemgetter(*[cls.index[f] for f in fields])
+        if len(fields) == 1:
+            return lambda t: (get(tuple(t)),)
+        return lambda t: get(tuple(t))
+
+    @classmethod
+    def define(cls, fields, shared=(), defaults=()):
+        '''Set up the fields of a record class.
+
+        :param fields: names of the fields in order
+        :param shared: fields whose strings should be shared
+        :param defaults: (field, value) pairs for missing fields
+        '''
+
+        cls.fields = tuple(fields)
+        cls.index = dict((f, i) for (i, f) in enumerate(cls.fields))
+        cls.shared = [cls.index[f] for f in shared if f in cls.index]
+        cls.default_values = [(cls.index[f], v) for (f, v) in defaults]
+
+# fields whose strings repeat across many tracks
+track_shared_fields = ('artist', 'album', 'albumArtist', 'composer', 'genre')
+
+class BansheeTrack(TrackRecord):
+    '''Banshee track, see get_b_library for its fields.'''
+    __slots__ = ()
+
+BansheeTrack.define(
+    ('id', 'uri', 'title', 'track', 'duration', 'disc', 'rating',
+     'playCount', 'genre', 'totalDiscs', 'totalTracks', 'year', 'artist',
+     'composer', 'album', 'albumArtist'), track_shared_fields)
+
+class GMTrack(TrackRecord):
+    '''Google Music song holding the fields banshee-gm uses.
+
+    The fields are those of the track key, those track can update, the
+    other metadata change_song_metadata is sent back with (name,
+    comment, beatsPerMinute, and albumArtUrl), and the ones telling
+    songs apart (id, storeId, durationMillis, and
+    lastModifiedTimestamp).  Songs without a track number get 0.
+    The library snapshot keeps the other fields apart (see
+    gm_song_extras).
+    '''
+    __slots__ = ()
+
+GMTrack.define(
+    ('id', 'title', 'album', 'artist', 'track', 'albumArtist', 'composer',
+     'disc', 'genre', 'playCount', 'rating', 'totalDiscs', 'totalTracks',
+     'year', 'name', 'comment', 'beatsPerMinute', 'albumArtUrl',
+     'durationMillis', 'storeId', 'lastModifiedTimestamp'),
+    track_shared_fields, [('track', 0)])
+
+def music_dir():
+    '''Return the directory holding the Banshee and GoogleMusic directories.'''
+
+    if music_root:
+        return music_root
+    return os.environ['HOME'] + '/Music'
 
 def uri_to_path(uri):
     '''Convert Banshee URI to file system path.
@@ -172,30 +997,272 @@ def gm_track_to_key(gm_track):
     return make_track_key(gm_track['track'], gm_track['title'],
                           gm_track['album'], gm_track['artist'])
 
-def get_gm_library(api):
+def gm_fill_keys(songs, keys, positions):
+    '''Set the track keys of some Google Music tracks.
+
+    :param songs: list of GMTrack records
+    :param keys: list of track keys parallel to songs
+    :param positions: indexes of the songs whose keys should be set
+
+    The keys are created all at once with make_track_keys.
+    '''
+
+    get = GMTrack.getter(('track', 'title', 'album', 'artist'))
+    rows = [get(songs[i]) for i in positions]
+    for (i, key) in zip(positions, make_track_keys(rows)):
+        keys[i] = key
+
+def gm_song_extras(song):
+    '''Return dictionary of the fields of a gm song GMTrack does not keep.
+
+    :param song: Google Music API track dictionary
+
+    Fields set to None are included as well, since records cannot tell
+    them from missing ones.
+    '''
+
+    index = GMTrack.index
+    return dict((k, v) for (k, v) in song.iteritems()
+                if k not in index or v is None)
+
+def load_snapshot(filename, version=snapshot_version):
+    '''Return the snapshot dictionary stored in filename.
+
+    :param filename: name of file to read
+    :param version: snapshot layout version that is acceptable
+
+    None is returned if the file does not exist, cannot be read, or
+    was written with a different snapshot layout.
+    '''
+
+    if not os.path.exists(filename):
+        return None
+    try:
+        with open(filename, 'rb') as f:
+            snapshot = cPickle.load(f)
+    except Exception as e:
+        logmsg('unable to read snapshot {0}: {1}'.format(filename, e), True)
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get('version') != version:
+        logmsg('ignoring outdated snapshot: {0}'.format(filename))
+        return None
+
+    # turn the plain tuples written by save_snapshot back into records
+    if 'songs' in snapshot:
+        snapshot['songs'] = [GMTrack(t, True) for t in snapshot['songs']]
+    if 'rows' in snapshot:
+        rows = snapshot['rows']
+        for (i, entry) in rows.iteritems():
+            if entry is not None:
+                rows[i] = (BansheeTrack(entry[0], True), entry[1])
+
+    return snapshot
+
+def save_snapshot(filename, snapshot):
+    '''Atomically write snapshot dictionary to filename.
+
+    :param filename: name of file to write to
+    :param snapshot: dictionary to store
+
+    Track records (the gm songs and the Banshee rows) are stored as
+    plain tuples, which pickle much faster.  Returns True if
+    successful.
+    '''
+
+    snapshot = dict(snapshot)
+    if 'songs' in snapshot:
+        snapshot['songs'] = [tuple(t) for t in snapshot['songs']]
+    if 'rows' in snapshot:
+        snapshot['rows'] = dict((i, entry and (tuple(entry[0]), entry[1]))
+                                for (i, entry) in snapshot['rows'].iteritems())
+    tmp = filename + '.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            cPickle.dump(snapshot, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, filename)
+    except (IOError, OSError) as e:
+        logmsg('unable to write snapshot {0}: {1}'.format(filename, e), True)
+        return False
+
+    return True
+
+def gm_snapshot_fresh(snapshot, max_age):
+    '''Return True if snapshot is younger than max_age seconds.
+
+    :param snapshot: snapshot dictionary as returned by load_snapshot
+    :param max_age: maximum age in seconds (None means never fresh)
+    '''
+
+    if not snapshot or max_age is None:
+        return False
+    return time.time() - snapshot['time'] <= max_age
+
+def gm_song_stamp(gm_track):
+    '''Return modification time stamp (microseconds) of a gm song.
+
+    :param gm_track: Google Music API track dictionary
+
+    Zero is returned if the song dictionary does not carry a
+    modification time stamp.
+    '''
+
+    try:
+        return int(gm_track.get('lastModifiedTimestamp', 0))
+    except (TypeError, ValueError):
+        return 0
+
+def get_gm_changes(api, stamp):
+    '''Return songs changed in Google Music since stamp.
+
+    :param api: Google Music API connection
+    :param stamp: modification time stamp (microseconds) to start from
+
+    Deleted songs are returned with the "deleted" element set.  None
+    is returned if the API does not support incremental downloads.
+    '''
+
+    since = datetime.utcfromtimestamp(stamp / 1e6)
+    try:
+        return list(api.get_all_songs(updated_after=since,
+                                      include_deleted=True))
+    except TypeError:
+        # older api without incremental support
+        return None
+
+def refresh_gm_snapshot(api, snapshot):
+    '''Bring the google music library snapshot up to date.
+
+    :param api: Google Music API connection
+    :param snapshot: previous snapshot dictionary (None if there is none)
+
+    If the previous snapshot and every song in it have modification
+    time stamps, only songs changed since the newest one are
+    downloaded.  Otherwise the entire library is downloaded and
+    compared with the previous snapshot so the keys of unchanged songs
+    need not be regenerated.  The new snapshot dictionary is returned.
+    Its elements are:
+
+    * version: snapshot layout version
+    * time: time the snapshot was taken
+    * stamp: newest song modification time stamp (0 if not available)
+    * songs: list of GMTrack records in library order
+    * keys: list of track keys parallel to songs
+    * extras: list of dictionaries parallel to songs holding the
+      fields the records do not keep (see gm_song_extras)
+    '''
+
+    changes = None
+    if snapshot and snapshot['stamp']:
+        logmsg("loading google music library changes")
+        changes = get_gm_changes(api, snapshot['stamp'])
+
+    if changes is not None:
+        # merge changes into previous snapshot
+        songs = snapshot['songs']
+        keys = snapshot['keys']
+        extras = snapshot['extras']
+        index = dict((t['id'], i) for (i, t) in enumerate(songs))
+        deleted = set()
+        added = 0
+        fresh = []
+        for t in changes:
+            i = index.get(t['id'])
+            if t.get('deleted'):
+                if i is not None:
+                    deleted.add(i)
+                continue
+            extra = gm_song_extras(t)
+            t = GMTrack(t)
+            if i is None:
+                i = index[t['id']] = len(songs)
+                songs.append(t)
+                keys.append(None)
+                extras.append(extra)
+                added += 1
+            else:
+                songs[i] = t
+                extras[i] = extra
+            fresh.append(i)
+        gm_fill_keys(songs, keys, fresh)
+        if deleted:
+            songs = [t for (i, t) in enumerate(songs) if i not in deleted]
+            keys = [k for (i, k) in enumerate(keys) if i not in deleted]
+            extras = [e for (i, e) in enumerate(extras) if i not in deleted]
+        logmsg("google music library changes: {0} ({1} new, {2} deleted)"
+               .format(len(changes), added, len(deleted)))
+    else:
+        # get all of the users songs
+        # library is a list of dictionaries, each of which contains a song
+        logmsg("loading google music library")
+        library = api.get_all_songs()
+        songs = [GMTrack(t) for t in library]
+        extras = [gm_song_extras(t) for t in library]
+        del library
+        logmsg("google music library loading complete")
+
+        # reuse keys of unchanged songs
+        old = {}
+        if snapshot:
+            old = dict((t['id'], (t, k)) for (t, k)
+                       in zip(snapshot['songs'], snapshot['keys']))
+        keys = []
+        fresh = []
+        for t in songs:
+            prev = old.pop(t.get('id'), None)
+            if prev and prev[0] == t:
+                keys.append(prev[1])
+            else:
+                fresh.append(len(keys))
+                keys.append(None)
+        gm_fill_keys(songs, keys, fresh)
+        if snapshot:
+            logmsg("google music library changes: {0} ({1} deleted)".format(
+                    len(fresh), len(old)))
+
+    # determine newest time stamp (only usable if every song has one)
+    stamps = [gm_song_stamp(t) for t in songs]
+    stamp = 0
+    if stamps and min(stamps) > 0:
+        stamp = max(stamps)
+
+    return {'version': snapshot_version, 'time': time.time(), 'stamp': stamp,
+            'songs': songs, 'keys': keys, 'extras': extras}
+
+def get_gm_library(api, snapshot=None, max_age=None, full=False):
     """Download tracks metadata and return in dictionary.
 
     :param api: Google Music API connection
+    :param snapshot: previous library snapshot (see load_snapshot)
+    :param max_age: use snapshot without refreshing if it is younger
+                    than max_age seconds
+    :param full: if True, the values are complete song dictionaries
+                 rather than GMTrack records
 
     The dictionary has keys generated by gm_track_to_key and the
-    values are the song dictionaries returned by
-    gmusicapi.api.get_all_songs().
+    values are GMTrack records of the songs returned by
+    gmusicapi.api.get_all_songs(), or with full the song dictionaries
+    put back together from the records and the snapshot extras.  The
+    refreshed library is saved in gm_snapshot_file for use by later
+    runs.
     """
 
-    # get all of the users songs
-    # library is a list of dictionaries, each of which contains a single song
-    logmsg("loading google music library")
-    gm_library = api.get_all_songs()
-    logmsg("google music library loading complete")
+    if gm_snapshot_fresh(snapshot, max_age):
+        logmsg("using google music library snapshot from {0:.0f}s ago".format(
+                time.time() - snapshot['time']))
+    else:
+        with metrics.span('gm_download'):
+            snapshot = refresh_gm_snapshot(api, snapshot)
+        save_snapshot(gm_snapshot_file, snapshot)
+    gm_library = snapshot['songs']
+    if full:
+        gm_library = [dict(t.iteritems(), **extra) for (t, extra)
+                      in zip(gm_library, snapshot['extras'])]
 
     # collect gm tracks
     gm_tracks = {}
     gm_dups = {}
     gm_zeros = {}
-    for t in gm_library:
-        # generate track key
-        key = gm_track_to_key(t)
-
+    for (t, key) in zip(gm_library, snapshot['keys']):
         # record tracks with zero track number
         if t['track'] == 0:
             gm_zeros[key] = t
@@ -221,14 +1288,17 @@ def get_gm_library(api):
 
     return gm_tracks
 
-def get_gm_playlists(api):
+def get_gm_playlists(api, details=False):
     '''Return dictionary of Google Music playlists.
 
     :param api: Google Music API connection
+    :param details: if True, include playlist and entry ids
 
     The dictionary has the name of the playlists as its keys and the
     values for each element is a list of the track keys (as generated
-    by gm_track_to_key).
+    by gm_track_to_key).  If details is True, the values are instead
+    tuples of the playlist id and a list of (track key, playlist entry
+    id, song id) tuples.
     '''
 
     # get user playlists
@@ -250,28 +1320,352 @@ def get_gm_playlists(api):
             # get tracks
             p_tracks = api.get_playlist_songs(pl_id)
 
-            # initialize list
-            gm_playlists[name] = []
-
-            # loop through songs
+            # get track keys for all songs at once
             for t in p_tracks:
-                # get track key
-                key = gm_track_to_key(t)
-                gm_playlists[name].append(key)
+                if 'track' not in t:
+                    t['track'] = 0
+            keys = normalizer.keys(
+                (t['track'], t['title'], t['album'], t['artist'])
+                for t in p_tracks)
+            if details:
+                gm_playlists[name] = (pl_id, [
+                        (k, t.get('playlistEntryId'), t.get('id'))
+                        for (k, t) in zip(keys, p_tracks)])
+            else:
+                gm_playlists[name] = keys
 
     return gm_playlists
 
-def get_b_library(banshee_conn, rating):
+# music files worth considering
+b_music_types = ('ogg', 'flac', 'mp3', 'm4a', 'wma')
+
+# columns of b_track_query in the order of the song record fields,
+# followed by the track key and the stamps of the last changes; the
+# key is NULL for files that are not music under music_dir and 0 for
+# files of an unknown type (see b_track_scope for the parameters)
+b_track_fields = BansheeTrack.fields
+b_track_query = """
+  select t.TrackID, t.Uri, t.Title, t.TrackNumber, t.Duration, t.Disc,
+    t.Rating, t.PlayCount, t.Genre, t.DiscCount, t.TrackCount, t.Year,
+    a.Name, t.Composer, l.Title, l.ArtistName,
+    case when t.Uri >= :music_lo and t.Uri < :music_hi
+        and t.Uri not like '%.pdf' then
+      case when {0}
+        then track_key(t.TrackNumber, t.Title, l.Title, a.Name)
+        else 0 end
+      end,
+    t.DateUpdatedStamp, t.LastPlayedStamp
+  from CoreTracks as t
+    join CoreArtists as a on t.ArtistID = a.ArtistID
+    join CoreAlbums as l on t.AlbumID = l.AlbumID""".format(
+    ' or '.join("t.Uri like '%.{0}'".format(ext) for ext in b_music_types))
+
+# index the index command adds to the banshee database, covering the
+# columns b_track_scope looks at
+b_sql_index = ('BansheeGmTracks', 'CoreTracks (Rating, Uri, Genre)')
+
+# file holding the banshee track index
+b_index_file = 'b.index'
+# files holding what link_tracks staged in GoogleMusic and
+# GoogleMusicUploads (see --verify)
+staging_manifest_files = {False: 'gm-staging.manifest',
+                          True: 'gm-uploads.manifest'}
+# file holding the index of all local banshee tracks (see fs)
+b_fs_index_file = 'b-fs.index'
+# private copy of the banshee database (see --copy-db)
+b_copy_file = 'b.copy.db'
+# rows fetched from the banshee database at a time
+b_fetch_size = 1000
+
+def sqlite_uris():
+    '''Return True if sqlite3.connect understands file: URIs.'''
+
+    conn = sqlite3.connect(':memory:')
+    try:
+        options = [row[0] for row in conn.execute('pragma compile_options')]
+    except sqlite3.Error:
+        options = []
+    conn.close()
+    return 'USE_URI' in options
+
+def connect_banshee(path, copy=None):
+    '''Open the Banshee database read-only and return the connection.
+
+    :param path: Banshee database
+    :param copy: if set, copy the database to this file (see
+                 copy_banshee_db) and read the copy instead
+
+    The database is opened through a "mode=ro" URI so nothing this
+    script does can take a write lock Banshee is waiting for (a copy
+    is also opened "immutable" so SQLite does no locking at all).
+    SQLite libraries not built to understand URIs get a plain
+    connection set to query_only instead.  The connection is in
+    autocommit mode, use read_transaction to read consistently.
+    '''
+
+    immutable = False
+    if copy:
+        path = copy_banshee_db(path, copy)
+        immutable = True
+    if sqlite_uris():
+        uri = 'file:{0}?mode=ro'.format(
+            urllib.pathname2url(os.path.abspath(path)))
+        if immutable:
+            uri += '&immutable=1'
+        conn = sqlite3.connect(uri)
+    else:
+        conn = sqlite3.connect(path)
+        conn.execute('pragma query_only = on')
+    conn.isolation_level = None
+    # map the database into memory and keep its pages around
+    conn.execute('pragma mmap_size = 268435456')
+    conn.execute('pragma cache_size = -65536')
+    return conn
+
+def copy_banshee_db(path, copy):
+    '''Copy the Banshee database to a private file and return its name.
+
+    :param path: Banshee database
+    :param copy: file to copy the database to
+
+    The database and its write-ahead log are copied while holding a
+    read transaction, so Banshee cannot checkpoint in the middle.
+    The log is then folded into the copy, which nothing else writes to.
+    '''
+
+    for suffix in ('', '-wal', '-shm', '-journal'):
+        if os.path.exists(copy + suffix):
+            os.remove(copy + suffix)
+    src = sqlite3.connect(path)
+    src.isolation_level = None
+    try:
+        with read_transaction(src):
+            for suffix in ('', '-wal'):
+                if os.path.exists(path + suffix):
+                    shutil.copyfile(path + suffix, copy + suffix)
+    finally:
+        src.close()
+    conn = sqlite3.connect(copy)
+    conn.execute('pragma journal_mode = delete')
+    conn.close()
+    logmsg('copied banshee database to {0}'.format(copy))
+    return copy
+
+@contextmanager
+def read_transaction(conn):
+    '''Read everything in the block from the same database snapshot.
+
+    :param conn: connection to the database
+
+    Blocks nest: an inner block simply reads in the transaction the
+    outer one started.  Reads never block Banshee (or the other way
+    around) with its write-ahead log, the snapshot is released as
+    soon as the outermost block ends.  The connection is put in
+    autocommit mode so the sqlite3 module does not end the
+    transaction on its own.
+    '''
+
+    if conn.isolation_level is not None:
+        conn.isolation_level = None
+    try:
+        conn.execute('begin')
+    except sqlite3.OperationalError:
+        # already in a transaction
+        yield conn
+        return
+    try:
+        # take the snapshot now rather than at the first query
+        conn.execute('select count(*) from sqlite_master').fetchone()
+        yield conn
+    finally:
+        conn.execute('rollback')
+
+def fetch_rows(cursor, size=None):
+    '''Iterate over the rows of an executed query in large batches.
+
+    :param cursor: cursor that executed a query
+    :param size: rows to fetch at a time (default b_fetch_size)
+    '''
+
+    if size is None:
+        size = b_fetch_size
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        for row in rows:
+            yield row
+
+def b_track_scope(rating):
+    '''Return SQL condition and parameters selecting the tracks to index.
+
+    :param rating: minimum rating of tracks, None for all local tracks
+
+    If a rating is given, only tracks with at least that rating whose
+    genre is not "Podcast" and whose files are under music_dir (and
+    not pdf files) are selected, otherwise all local (file://) tracks
+    are.  The URIs are compared as ranges so an index on Uri can be
+    used.  The parameters also hold those of b_track_query.
+    '''
+
+    prefix = 'file://' + music_dir()
+    params = {'music_lo': prefix,
+              'music_hi': prefix[:-1] + unichr(ord(prefix[-1]) + 1),
+              'rating': rating}
+    if rating is None:
+        return ("t.Uri >= 'file://' and t.Uri < 'file:/0'", params)
+    return ("""t.Rating >= :rating and t.Genre != 'Podcast'
+        and t.Uri >= :music_lo and t.Uri < :music_hi
+        and t.Uri not like '%.pdf'""", params)
+
+def b_row_to_track(row):
+    '''Convert b_track_query row to song record and track key.
+
+    :param row: row returned by b_track_query
+
+    A tuple of the BansheeTrack and the track key is returned.  The
+    key is None for tracks that are not local music files and False
+    for local files of an unknown type.
+    '''
+
+    key = row[len(b_track_fields)]
+    if key == 0:
+        key = False
+    return (BansheeTrack(row[:len(b_track_fields)]), key)
+
+def refresh_b_index(banshee_conn, index=None, rating=None):
+    '''Bring the index of Banshee tracks up to date.
+
+    :param banshee_conn: connection to Banshee database
+    :param index: previous index (None to read the whole database)
+    :param rating: only index tracks worth pushing with at least this
+                   rating (None to index all local tracks)
+
+    Which tracks are indexed is decided by the database (see
+    b_track_scope), which also makes the track keys with the
+    track_key function registered on the connection, unless the whole
+    database is read with shards (see make_track_keys).  Only tracks
+    whose DateUpdatedStamp or LastPlayedStamp is newer than the newest
+    seen before, and tracks with unknown TrackIDs, are read.  Tracks
+    deleted or no longer selected are found by comparing TrackID sets.
+    Changes to artists or albums that do not touch their tracks are
+    not noticed (see --full).  The index dictionary is returned.  Its
+    elements are:
+
+    * version: snapshot layout version
+    * time: time the index was refreshed
+    * db: path to the Banshee database
+    * prefix: URI prefix of local music files
+    * rating: minimum rating of the indexed tracks
+    * updated: newest DateUpdatedStamp
+    * played: newest LastPlayedStamp
+    * last_id: largest TrackID
+    * rows: dictionary of TrackID and (song record, track key)
+      tuples as returned by b_row_to_track
+    '''
+
+    # make sure the index describes this database, music directory,
+    # and selection of tracks
+    db = banshee_conn.execute('pragma database_list').fetchone()[2]
+    prefix = 'file://' + music_dir()
+    if index and (index['db'] != db or index['prefix'] != prefix
+                  or index.get('rating', False) != rating):
+        logmsg('banshee index does not match database, rebuilding')
+        index = None
+    (scope, params) = b_track_scope(rating)
+    # when reading the whole database, the keys are made afterwards so
+    # they can be spread over shards (1 marks the rows needing one)
+    shard_keys = index is None and shards > 1
+    if shard_keys:
+        banshee_conn.create_function('track_key', 4, lambda *args: 1)
+    else:
+        banshee_conn.create_function('track_key', 4, make_track_key)
+
+    # read everything from one snapshot of the database
+    with read_transaction(banshee_conn):
+        banshee_c = banshee_conn.cursor()
+        if index is None:
+            index = {'version': snapshot_version, 'db': db, 'prefix': prefix,
+                     'rating': rating, 'updated': 0, 'played': 0,
+                     'last_id': 0, 'rows': {}}
+            ids = None
+            banshee_c.execute(b_track_query + """
+              where """ + scope, params)
+        else:
+            # find deleted tracks
+            banshee_c.execute("""
+              select t.TrackID from CoreTracks as t
+              where """ + scope, params)
+            ids = set(row[0] for row in fetch_rows(banshee_c))
+            deleted = [i for i in index['rows'] if i not in ids]
+            for i in deleted:
+                del index['rows'][i]
+            logmsg('banshee tracks deleted since last run: {0}'.format(
+                    len(deleted)))
+            # get changed and new tracks
+            params.update((k, index[k]) for k in
+                          ('updated', 'played', 'last_id'))
+            banshee_c.execute(b_track_query + """
+              where (t.DateUpdatedStamp > :updated
+                or t.LastPlayedStamp > :played
+                or t.TrackID > :last_id)
+                and """ + scope, params)
+
+        rows = index['rows']
+        changed = 0
+        for row in fetch_rows(banshee_c):
+            rows[row[0]] = b_row_to_track(row)
+            index['updated'] = max(index['updated'], row[-2])
+            index['played'] = max(index['played'], row[-1])
+            changed += 1
+
+        # pick up new tracks reusing old ids
+        if ids is not None:
+            new_ids = list(ids.difference(rows))
+            while new_ids:
+                chunk = new_ids[:500]
+                new_ids = new_ids[500:]
+                names = [':id{0}'.format(i) for i in range(len(chunk))]
+                params.update(zip((n[1:] for n in names), chunk))
+                banshee_c.execute(
+                    b_track_query + " where t.TrackID in ({0})".format(
+                        ','.join(names)), params)
+                for row in fetch_rows(banshee_c):
+                    rows[row[0]] = b_row_to_track(row)
+                    changed += 1
+                # tracks without artist or album are never returned
+                for i in chunk:
+                    rows.setdefault(i, None)
+            logmsg('banshee tracks changed since last run: {0}'.format(
+                    changed))
+
+    if shard_keys:
+        ids = [i for (i, entry) in rows.iteritems() if entry[1] == 1]
+        tracks = [rows[i][0] for i in ids]
+        get = BansheeTrack.getter(('track', 'title', 'album', 'artist'))
+        keys = make_track_keys([get(t) for t in tracks])
+        for (i, t, key) in zip(ids, tracks, keys):
+            rows[i] = (t, key)
+
+    if rows:
+        index['last_id'] = max(rows)
+    index['time'] = time.time()
+
+    return index
+
+def get_b_library(banshee_conn, rating, full=False):
     """Read Banshee database and return dictionary tracks with rating greater than RATING.
 
     :param banshee_conn: connection to Banshee database
     :param rating: minimum rating of tracks to return
+    :param full: if True, ignore the saved index and read all tracks
 
-    Dictionary keys are the standard track keys and the values are a
-    song dictionary modeled after that returned by
-    gmusicapi.api.get_all_songs.  Only local music files (file://
-    URIs) that do not have the genre "Podcast" are considered.  The
-    dictionary elements are:
+    Dictionary keys are the standard track keys and the values are
+    BansheeTrack records modeled after the song dictionaries returned
+    by gmusicapi.api.get_all_songs.  Only local music files (file://
+    URIs under music_dir) that do not have the genre "Podcast" are
+    read from the database (see b_track_scope).  The record fields
+    are:
 
     * id: unique identifier (integer)
     * uri: URI of song file
@@ -289,244 +1683,1399 @@ def get_b_library(banshee_conn, rating):
     * totalTracks: total number of tracks on disc
     * track: track number
     * year: year of song's release
+
+    The tracks are kept in an index (see refresh_b_index) saved in
+    b_index_file so later runs only need to read changed tracks.
     """
 
-    banshee_c = banshee_conn.cursor()
-    # get all songs with a three or better rating
-    t = (rating,)
-    banshee_c.execute("""
-      select t.TrackID, t.Uri, t.Title, t.TrackNumber, t.Duration, t.Disc,
-        t.Rating, t.PlayCount, t.Genre, t.DiscCount, t.TrackCount, t.Year,
-        a.Name, t.Composer, l.Title, l.ArtistName
-      from CoreTracks as t
-        join CoreArtists as a on t.ArtistID = a.ArtistID
-        join CoreAlbums as l on t.AlbumID = l.AlbumID
-      where t.Rating >= ?
-        and Genre <> 'Podcast'""", t)
+    index = None
+    if not full:
+        index = load_snapshot(b_index_file)
+    with metrics.span('b_sqlite'):
+        index = refresh_b_index(banshee_conn, index, rating)
+    save_snapshot(b_index_file, index)
+
+    return select_b_tracks(index, rating)
 
-    # compile regular expressions
-    re_prefix = re.compile('^file://' + os.environ['HOME'] + '/Music')
-    re_pdf = re.compile('\.pdf$', re.I)
-    re_mime = re.compile('\.(ogg|flac|mp3|m4a|wma)$', re.I)
+def select_b_tracks(index, rating, verbose=True):
+    '''Return dictionary of the tracks in a Banshee index worth pushing.
 
-    # process tracks
+    :param index: Banshee track index (see refresh_b_index)
+    :param rating: minimum rating of tracks to return
+    :param verbose: if False, do not log or write reports
+
+    See get_b_library for the tracks returned.
+    '''
+
+    # process tracks in database order
     b_tracks = {}
     b_dups = {}
     rows = 0
     tracks = 0
-    for row in banshee_c:
+    for track_id in sorted(index['rows']):
+        entry = index['rows'][track_id]
+        if entry is None:
+            continue
+        (t, key) = entry
+
+        # get all songs with sufficient rating, skipping podcasts
+        # (NULL ratings and genres never match, just like in sql)
+        if t['rating'] is None or t['rating'] < rating:
+            continue
+        if t['genre'] is None or t['genre'] == 'Podcast':
+            continue
+
         # increment row counter
         rows += 1
 
-        # would be nice if you could do slice assignment with dictionary
-        t = {}
-        (t['id'], t['uri'], t['title'], t['track'], t['duration'], t['disc'],
-         t['rating'], t['playCount'], t['genre'], t['totalDiscs'],
-         t['totalTracks'], t['year'], t['artist'], t['composer'],
-         t['album'], t['albumArtist']) = row
+        # only look at local music files
+        if key is None:
+            continue
+        if key is False:
+            if verbose:
+                logmsg('unknown file type: {0}'.format(t['uri']))
+            continue
+
+        # looks like a real music track
+        tracks += 1
+
+        # see if track is a duplicate
+        if key in b_tracks:
+            if key in b_dups:
+                b_dups[key].append(t['uri'])
+            else:
+                b_dups[key] = [b_tracks[key]['uri'], t['uri']]
+        else:
+            b_tracks[key] = t
+
+    if not verbose:
+        return b_tracks
+
+    # report metrics
+    logmsg('banshee rows: {0}'.format(rows))
+    logmsg('banshee tracks: {0}'.format(tracks))
+    logmsg("banshee dups: {0}".format(len(b_dups)))
+    logmsg("banshee unique tracks: {0}".format(len(b_tracks)))
+
+    # write banshee dups
+    write_keys('b.dup', b_dups)
+
+    return b_tracks
+
+def get_b_playlists(banshee_conn, playlists=[], track_keys=None):
+    '''Return dictionary of Banshee playlists.
+
+    :param banshee_conn: connection to Banshee database
+    :param playlists: playlists to return (return all if none specified)
+    :param track_keys: dictionary of TrackID and track key for tracks
+                       whose keys are already known
+
+    The dictionary has the names of the playlists as its keys and a
+    list of track keys (as generated by make_track_key) as its values.
+    The entries of all the playlists are read with a single query,
+    in the same transaction as the playlists themselves.
+    '''
+
+    if track_keys is None:
+        track_keys = {}
+    with read_transaction(banshee_conn):
+        return read_b_playlists(banshee_conn, playlists, track_keys)
+
+def read_b_playlists(banshee_conn, playlists, track_keys):
+    '''Read Banshee playlists, see get_b_playlists.'''
+
+    # look up all playlists at once
+    banshee_c = banshee_conn.cursor()
+    banshee_c.execute('select PlaylistID, Name from CorePlaylists')
+    pl_ids = {}
+    for (pl_id, p_name) in fetch_rows(banshee_c):
+        pl_ids.setdefault(p_name, []).append(pl_id)
+
+    # see if playlists were provided
+    names = playlists
+    if not playlists:
+        names = sorted(pl_ids)
+    pl_to_get = {}
+    for p_name in names:
+        count = len(pl_ids.get(p_name, []))
+        if count == 0:
+            logmsg('banshee playlist does not exist: {0}'.format(p_name),
+                   True)
+            # need to check smart playlists
+        elif count > 1:
+            logmsg('multiple banshee playlists match: {0}'.format(p_name),
+                   True)
+        else:
+            pl_to_get[pl_ids[p_name][0]] = p_name
+
+    # get the entries of all the playlists
+    b_playlists = dict((p_name, []) for p_name in pl_to_get.itervalues())
+    query = '''
+      select e.PlaylistID, e.TrackID, a.Name, t.Title, t.TrackNumber, l.Title
+      from CorePlaylistEntries as e
+        join CoreTracks as t on e.TrackID = t.TrackID
+        join CoreArtists as a on t.ArtistID = a.ArtistID
+        join CoreAlbums as l on t.AlbumID = l.AlbumID'''
+    order = '''
+      order by e.PlaylistID, e.ViewOrder, e.EntryID'''
+    if playlists:
+        ids = sorted(pl_to_get)
+        chunks = [ids[i:i + 500] for i in range(0, len(ids), 500)]
+    else:
+        chunks = [None]
+    for chunk in chunks:
+        if chunk is None:
+            banshee_c.execute(query + order)
+        else:
+            banshee_c.execute(query + '''
+      where e.PlaylistID in ({0})'''.format(','.join('?' * len(chunk)))
+                              + order, chunk)
+        entries = fetch_rows(banshee_c)
+        for (pl_id, track_id, artist, title, n, album) in entries:
+            if pl_id not in pl_to_get:
+                continue
+            # reuse or create key
+            key = track_keys.get(track_id)
+            if key is None:
+                key = make_track_key(n, title, album, artist)
+            b_playlists[pl_to_get[pl_id]].append(key)
+
+    return b_playlists
+
+def index_banshee(path, args):
+    '''Add the index speeding up reading tracks to the Banshee database.
+
+    :param path: Banshee database
+    :param args: ['drop'] to remove the index again
+
+    The index (see b_sql_index) covers the columns selecting the
+    tracks worth pushing, so refreshing the track index never reads
+    the whole CoreTracks table.  This is the only time the Banshee
+    database is written to.
+    '''
+
+    if args not in ([], ['drop']):
+        logmsg('usage: index [drop]', True)
+        return False
+    (name, columns) = b_sql_index
+    if args:
+        sql = 'drop index if exists {0}'.format(name)
+    else:
+        sql = 'create index if not exists {0} on {1}'.format(name, columns)
+    if dryrun:
+        logmsg('would run on {0}: {1}'.format(path, sql))
+        return True
+
+    # wait for banshee to finish writing
+    conn = sqlite3.connect(path, timeout=60)
+    try:
+        with conn:
+            conn.execute(sql)
+    except sqlite3.Error as e:
+        logmsg('unable to change banshee database: {0}: {1}'.format(path, e),
+               True)
+        return False
+    finally:
+        conn.close()
+    logmsg('ran on {0}: {1}'.format(path, sql))
+    return True
+
+def list_dir(path):
+    '''Return list of (name, path, is_dir) tuples for entries in a directory.
+
+    :param path: directory to list
+
+    Symbolic links are never reported as directories.  If available,
+    scandir is used so no extra stat calls are needed.
+    '''
+
+    if scandir is not None:
+        return [(e.name, e.path, e.is_dir(follow_symlinks=False))
+                for e in scandir(path)]
+
+    entries = []
+    for name in os.listdir(path):
+        p = os.path.join(path, name)
+        entries.append((name, p, stat.S_ISDIR(os.lstat(p).st_mode)))
+    return entries
+
+class PathCache(object):
+    '''Resolve paths and check that they exist a directory at a time.
+
+    Every directory is listed once (with scandir, if available) and
+    the real path of every directory is worked out once, resolving the
+    symbolic links on the way from the listings of its parents.  The
+    real path of a file is then the real path of its directory joined
+    with its name, and whether it exists is looked up in the listing.
+    Only files that are symbolic links themselves (or are in
+    directories that cannot be read) need system calls of their own.
+
+    Hits count directories found in memory, misses the directories
+    listed and the paths handed to os.path (see stats).  Paths are
+    handled as byte strings.  Changes to a directory after it was
+    listed are not seen, see forget.
+    '''
+
+    # kinds of directory entries
+    (FILE, DIR, LINK) = range(3)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.dirs = {}
+        self.listings = {}
+        self.hits = 0
+        self.misses = 0
+
+    def count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    @staticmethod
+    def encode(path):
+        '''Return path as a byte string.'''
+        if isinstance(path, unicode):
+            return path.encode(sys.getfilesystemencoding() or 'utf-8')
+        return path
+
+    def read_dir(self, path):
+        '''Return dictionary of entry names and kinds of a directory.
+
+        :param path: real path of the directory
+
+        A directory that does not exist has no entries.  None is
+        returned if the directory cannot be read.
+        '''
+
+        entries = self.listings.get(path)
+        if entries is not None:
+            self.count(True)
+            return entries
+        self.count(False)
+        entries = {}
+        try:
+            if scandir is not None:
+                for e in scandir(path):
+                    if e.is_symlink():
+                        entries[e.name] = self.LINK
+                    elif e.is_dir(follow_symlinks=False):
+                        entries[e.name] = self.DIR
+                    else:
+                        entries[e.name] = self.FILE
+            else:
+                for name in os.listdir(path):
+                    mode = os.lstat(os.path.join(path, name)).st_mode
+                    if stat.S_ISLNK(mode):
+                        entries[name] = self.LINK
+                    elif stat.S_ISDIR(mode):
+                        entries[name] = self.DIR
+                    else:
+                        entries[name] = self.FILE
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                return None
+            entries = {}
+        self.listings[path] = entries
+        return entries
+
+    def resolve(self, path):
+        '''Return real path of byte string path.'''
+
+        (parent, name) = os.path.split(path)
+        if not os.path.isabs(path) or name in ('', '.', '..'):
+            self.count(False)
+            return os.path.realpath(path)
+        real_parent = self.real_dir(parent)
+        entries = self.read_dir(real_parent)
+        real = os.path.join(real_parent, name)
+        if entries is None or entries.get(name) == self.LINK:
+            self.count(False)
+            return os.path.realpath(real)
+        return real
+
+    def real_dir(self, path):
+        '''Return real path of a directory, working it out only once.'''
+
+        path = self.encode(path)
+        real = self.dirs.get(path)
+        if real is not None:
+            self.count(True)
+            return real
+        real = self.dirs[path] = self.resolve(path)
+        return real
+
+    def real_path(self, path):
+        '''Return real path of a file (see os.path.realpath).'''
+        return self.resolve(self.encode(path))
+
+    def exists(self, path):
+        '''Return True if path exists (see os.path.exists).'''
+
+        path = self.encode(path)
+        (parent, name) = os.path.split(path)
+        if not os.path.isabs(path) or name in ('', '.', '..'):
+            self.count(False)
+            return os.path.exists(path)
+        entries = self.read_dir(self.real_dir(parent))
+        kind = self.LINK
+        if entries is not None:
+            kind = entries.get(name)
+        if kind == self.LINK:
+            # see where the link leads
+            self.count(False)
+            return os.path.exists(path)
+        return kind is not None
+
+    def list_dir(self, path):
+        '''Return list_dir(path), keeping the listing for later questions.
+
+        :param path: real path of the directory
+        '''
+
+        path = self.encode(path)
+        entries = self.read_dir(path)
+        if entries is None:
+            return list_dir(path)
+        return [(name, os.path.join(path, name), kind == self.DIR)
+                for (name, kind) in entries.iteritems()]
+
+    def forget(self, path=None):
+        '''Drop the listing of directory path (of all directories if None).'''
+
+        if path is None:
+            self.listings = {}
+        else:
+            self.listings.pop(self.encode(path), None)
+
+    def stats(self):
+        '''Return (hits, misses).'''
+        return (self.hits, self.misses)
+
+# paths resolved by link_tracks and fs
+path_cache = PathCache()
+
+def prune_tree(root, keep):
+    '''Remove files not in keep and directories left empty below root.
+
+    :param root: directory to prune (it is never removed itself)
+    :param keep: container of file paths to keep
+
+    The tree is traversed once, bottom up, removing files and then
+    the directories they leave empty.  A tuple of the number of entries
+    scanned and removed is returned.
+    '''
+
+    counts = [0, 0]
+
+    def prune(path):
+        # returns number of entries left in path
+        left = 0
+        for (name, p, is_dir) in list_dir(path):
+            counts[0] += 1
+            if is_dir:
+                if prune(p):
+                    left += 1
+                    continue
+                if not dryrun:
+                    os.rmdir(p)
+                logmsg(u"removed empty directory: {0}".format(p), False,
+                       'prune')
+            else:
+                # make sure it does not belong
+                if p in keep:
+                    left += 1
+                    continue
+                # rm the file
+                if not dryrun:
+                    os.unlink(p)
+                logmsg(u"removed: {0}".format(p), False, 'prune')
+            counts[1] += 1
+            if dryrun:
+                left += 1
+        return left
+
+    if os.path.isdir(root):
+        prune(root)
+
+    return tuple(counts)
+
+def unstage_links(links, root):
+    '''Remove links and the directories they leave empty below root.
+
+    :param links: real paths of the links to remove
+    :param root: real path of the staging directory (never removed)
+
+    Links that are already gone are skipped.  The number of entries
+    removed is returned.
+    '''
+
+    removed = 0
+    dirs = set()
+    for link in sorted(links):
+        if not dryrun:
+            try:
+                os.unlink(link)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    logmsg(u'failed to remove: {0}: {1}'.format(link, e),
+                           True)
+                continue
+        logmsg(u"removed: {0}".format(link), False, 'prune')
+        removed += 1
+        dirs.add(os.path.dirname(link))
+    if dryrun:
+        return removed
+
+    # remove the directories left empty, deepest first
+    for d in sorted(dirs, key=len, reverse=True):
+        while d.startswith(root + os.sep):
+            try:
+                os.rmdir(d)
+            except OSError:
+                break
+            logmsg(u"removed empty directory: {0}".format(d), False, 'prune')
+            removed += 1
+            d = os.path.dirname(d)
+
+    return removed
+
+def link_tracks(tracks, up=False, verify=False):
+    """Create directory structure and hard link tracks in Banshee that need to be in Google Music.
+
+    :param tracks: dictionary of track key,uri values
+    :param up: if true, create links in ~/Music/GoogleMusicUploads rather than ~/Music/GoogleMusic
+    :param verify: if true, check every link and the whole staging
+                   directory instead of trusting the manifest
+
+    This method with create links for files in the tracks dictionary and
+    remove links for files not in it.  What was staged is kept in a
+    manifest (see staging_manifest_files) holding the URI, source and
+    link paths, and inode and modification time of every track.  Tracks
+    staged before with the same URI are not looked at again and only
+    the links of tracks no longer wanted are removed.  Without a
+    manifest, or with verify, every link is checked, links to files
+    that were replaced are made again, and everything else in the
+    staging directory is pruned.  Return True if successful.
+    """
+
+    # set root paths
+    music = music_dir()
+    src_root = music + '/Banshee'
+    target_root = music + '/GoogleMusic'
+    if up:
+        target_root = target_root + 'Uploads'
+    manifest_file = staging_manifest_files[bool(up)]
+
+    # prepare regex
+    src_root_re = re.compile('^' + src_root)
+
+    # see what was staged before
+    manifest = load_snapshot(manifest_file)
+    if manifest and manifest['root'] != target_root:
+        logmsg('staging manifest is for another directory, ignoring it')
+        manifest = None
+    old = {}
+    if manifest:
+        old = manifest['entries']
+    # track key and (uri, source, link, inode, mtime) of staged tracks
+    staged = {}
+    if not verify:
+        for (key, uri) in tracks.iteritems():
+            entry = old.get(key)
+            if entry is not None and entry[0] == uri:
+                staged[key] = entry
+    incremental = manifest is not None and not verify
+    unchanged = len(staged)
+
+    # determine source and link paths (in a stable order)
+    paths = []
+    for (key, uri) in sorted((key, uri) for (key, uri) in tracks.iteritems()
+                             if key not in staged):
+        src = uri_to_path(uri)
+        if not src:
+            # uri_to_path will report the problem
+            continue
+        # initiate link path
+        link = src_root_re.sub(target_root, src)
+        paths.append((key, uri, src, link))
+
+    # determine real paths (avoid sym link issues) and see what exists
+    def resolve(paths):
+        (key, uri, src, link) = paths
+        src_real = path_cache.real_path(src)
+        link_real = path_cache.real_path(link)
+        link_exists = path_cache.exists(link_real)
+        src_exists = link_exists or path_cache.exists(src_real)
+        # a link to a file that was replaced is stale
+        stale = False
+        if link_exists and verify:
+            try:
+                stale = os.stat(link_real).st_ino != os.stat(src_real).st_ino
+            except OSError:
+                pass
+        return (key, uri, src, src_real, link_real, link_exists and not stale,
+                src_exists, stale)
+
+    pool = None
+    pool_map = map
+    if jobs > 1:
+        pool = ThreadPool(jobs)
+        pool_map = pool.map
+
+    # dictionary for valid links
+    valid_links = dict.fromkeys((e[2] for e in staged.itervalues()), 1)
+    # links that need to be created
+    to_link = []
+    # tracks whose links are in place
+    in_place = []
+    # tracks whose links are not what the manifest says
+    drifted = set()
+    with metrics.span('link_resolve'):
+        resolved = pool_map(resolve, paths)
+    for (key, uri, src, src_real, link_real, link_exists, src_exists,
+         stale) in resolved:
+        # see if link already exists (or is already queued)
+        if link_real in valid_links:
+            continue
+        # store valid links for later pruning
+        valid_links[link_real] = 1
+        # see if the link is not what the manifest says
+        entry = old.get(key)
+        if entry is not None and entry[0] == uri and (stale or not link_exists):
+            drifted.add(key)
+        if link_exists:
+            in_place.append((key, uri, src_real, link_real))
+            continue
+
+        # make sure source exists
+        if not src_exists:
+            logmsg(u'original file does not exist: {0}, {1}'.format(uri, src),
+                   True)
+            continue
+
+        to_link.append((key, uri, src_real, link_real, stale))
+
+    # create paths to links, once for each directory
+    bad_dirs = set()
+    if not dryrun:
+        for link_dir in sorted(set(os.path.dirname(link_real)
+                                   for (key, uri, src_real, link_real, stale)
+                                   in to_link)):
+            if not path_cache.exists(link_dir) and not mkpath(link_dir):
+                logmsg(u'failed to create dir: {0}'.format(link_dir), True)
+                bad_dirs.add(link_dir)
+
+    # create hard links
+    def make_link(paths):
+        (key, uri, src_real, link_real, stale) = paths
+        if os.path.dirname(link_real) in bad_dirs:
+            return False
+        try:
+            if not dryrun:
+                if stale:
+                    os.unlink(link_real)
+                os.link(src_real, link_real)
+        except OSError:
+            return None
+        return True
+
+    with metrics.span('link_create'):
+        linked_all = pool_map(make_link, to_link)
+    for ((key, uri, src_real, link_real, stale), linked) in zip(to_link,
+                                                                linked_all):
+        if linked is None:
+            logmsg(u'failed to link: {0}, {1}'.format(src_real, link_real),
+                   True)
+        elif linked:
+            logmsg(u"created link: {0}".format(link_real), False, 'link')
+            in_place.append((key, uri, src_real, link_real))
+
+    # remember the inode and modification time of the new links
+    def stat_link(paths):
+        (key, uri, src_real, link_real) = paths
+        try:
+            st = os.stat(link_real)
+        except OSError:
+            return (key, (uri, src_real, link_real, None, None))
+        return (key, (uri, src_real, link_real, st.st_ino, st.st_mtime))
+
+    with metrics.span('link_stat'):
+        for (key, entry) in pool_map(stat_link, in_place):
+            if verify and key in old and old[key][:3] == entry[:3] \
+                    and old[key][3:] != entry[3:]:
+                drifted.add(key)
+            staged[key] = entry
+
+    if pool:
+        pool.close()
+        pool.join()
+    # the links and directories made are not in the listings
+    path_cache.forget()
+
+    # remove unneeded files and directories
+    target_root_real = path_cache.real_dir(target_root)
+    with metrics.span('link_prune'):
+        if incremental:
+            wanted = set(e[2] for e in staged.itervalues())
+            removed = unstage_links(set(e[2] for e in old.itervalues()
+                                        if e[2] not in wanted),
+                                    target_root_real)
+            logmsg('staging tracks unchanged: {0}, linked: {1}, '
+                   'removed: {2}'.format(unchanged, len(to_link), removed))
+        else:
+            (scanned, removed) = prune_tree(target_root_real, valid_links)
+            logmsg('staging entries scanned: {0}, removed: {1}'.format(
+                    scanned, removed))
+    if verify and manifest:
+        logmsg('staging drift from manifest: {0}'.format(len(drifted)))
+
+    # remember what is staged
+    if not dryrun and staged != old:
+        save_snapshot(manifest_file, {'version': snapshot_version,
+                                      'time': time.time(),
+                                      'root': target_root,
+                                      'entries': staged})
+
+    return True
+
+class MutationExecutor(object):
+    '''Run Google Music API calls with rate and concurrency limits.
+
+    :param rate: maximum number of calls per second
+    :param concurrency: maximum number of calls in flight at once
+    :param slow: calls taking longer than this many seconds count as
+                 a sign of trouble
+    :param retries: number of times to retry a call that raises
+    :param batch_size: maximum number of items changed per call
+
+    Calls are paced by a token bucket.  A failed or slow call halves
+    the current rate (down to 1/16th of the requested rate), and each
+    good call adds back a tenth of the requested rate.  Work submitted
+    with submit() runs on a pool of concurrency worker threads and
+    makes its API calls through call().  The latency of every call is
+    recorded for report().  Changes to many songs are sent batch_size
+    songs at a time by call_batch().
+    '''
+
+    def __init__(self, rate=0.5, concurrency=1, slow=10.0, retries=2,
+                 batch_size=25):
+        self.max_rate = float(rate)
+        self.rate = self.max_rate
+        self.concurrency = max(1, concurrency)
+        self.slow = slow
+        self.retries = retries
+        self.batch_size = max(1, batch_size)
+        # token bucket state
+        self.tokens = 1.0
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+        # accounting
+        self.latencies = []
+        self.failures = 0
+        self.backoffs = 0
+        # work queue and worker threads, started on first submit
+        self.queue = Queue()
+        self.workers = []
+
+    def acquire(self):
+        '''Block until the token bucket allows another call.'''
+
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.concurrency, self.tokens
+                                  + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            metrics.observe('executor.wait', wait)
+            time.sleep(wait)
+
+    def adapt(self, ok, latency):
+        '''Adjust the call rate based on the outcome of a call.
+
+        :param ok: True if the call succeeded
+        :param latency: duration of the call in seconds
+        '''
+
+        with self.lock:
+            self.latencies.append(latency)
+            if ok and latency <= self.slow:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+            else:
+                self.rate = max(self.max_rate / 16, self.rate / 2)
+                self.backoffs += 1
+                if not ok:
+                    self.failures += 1
+
+    def call(self, func, *args):
+        '''Rate limit, time, and return the result of func(*args).
+
+        :param func: API method to call
+        :param args: arguments to pass to func
+
+        Calls raising an exception are retried.  A false return value
+        counts as a failure but is returned to the caller to deal with.
+        None is returned if every attempt raised.
+        '''
+
+        attempt = 0
+        while True:
+            self.acquire()
+            start = time.time()
+            try:
+                rv = func(*args)
+            except Exception as e:
+                self.adapt(False, time.time() - start)
+                attempt += 1
+                logmsg('google music call {0} failed (attempt {1}): {2}'.format(
+                        func.__name__, attempt, e), True)
+                if attempt > self.retries:
+                    return None
+                continue
+            self.adapt(bool(rv), time.time() - start)
+            return rv
+
+    def batches(self, items):
+        '''Return list of items split into batch_size chunks.'''
+        return [items[i:i + self.batch_size]
+                for i in range(0, len(items), self.batch_size)]
+
+    def call_batch(self, func, args, items):
+        '''Make one call changing several songs, isolating failures.
+
+        :param func: API method taking a list as its last argument
+        :param args: tuple of arguments preceding the list
+        :param items: list of (label, value, song id) tuples, the values
+                      are passed to func
+
+        Items whose song id is missing from the response are reported
+        as failed.  If the call as a whole fails, the batch is split in
+        half and each half is retried until the bad items are found.
+        The list of labels of failed items is returned.
+        '''
+
+        if not items:
+            return []
+        rv = self.call(func, *(args + ([v for (l, v, i) in items],)))
+        if not rv:
+            if len(items) > 1:
+                half = len(items) // 2
+                return (self.call_batch(func, args, items[:half])
+                        + self.call_batch(func, args, items[half:]))
+            return [items[0][0]]
+
+        # see which items made it
+        done = set(response_ids(rv))
+        return [l for (l, v, i) in items if i not in done]
+
+    def worker(self):
+        '''Run submitted work until the program exits.'''
+
+        while True:
+            (func, args) = self.queue.get()
+            try:
+                func(*args)
+            except Exception as e:
+                logmsg('mutation failed: {0}'.format(e), True)
+            finally:
+                self.queue.task_done()
+
+    def submit(self, func, *args):
+        '''Queue func(*args) to run on a worker thread.
+
+        :param func: function to run, should make API calls using call()
+        :param args: arguments to pass to func
+        '''
+
+        if not self.workers:
+            for i in range(self.concurrency):
+                w = threading.Thread(target=self.worker)
+                w.daemon = True
+                w.start()
+                self.workers.append(w)
+        self.queue.put((func, args))
+
+    def join(self):
+        '''Wait for all submitted work to finish.'''
+        self.queue.join()
+
+    def report(self):
+        '''Log call count, failures, and latency statistics.'''
+
+        if not self.latencies:
+            return
+        lat = sorted(self.latencies)
+        n = len(lat)
+        logmsg('google music calls: {0}, failures: {1}, backoffs: {2}'.format(
+                n, self.failures, self.backoffs))
+        logmsg('google music call latency: mean {0:.3f}s, median {1:.3f}s, '
+               '95% {2:.3f}s, max {3:.3f}s'.format(
+                sum(lat) / n, lat[n // 2], lat[int(n * 0.95)], lat[-1]))
+
+def playlist_edits(current, wanted):
+    '''Return the edits that turn one list of track keys into another.
+
+    :param current: list of track keys in the playlist now
+    :param wanted: list of track keys the playlist should have
+
+    The lists are compared with difflib, which finds a longest run of
+    common keys in order.  A tuple of three lists is returned: the
+    indices into current of keys to remove, the indices into wanted of
+    keys to insert, and (current index, wanted index) pairs of keys
+    that stay in place.
+    '''
+
+    removed = []
+    inserted = []
+    matched = []
+    sm = difflib.SequenceMatcher(None, current, wanted, autojunk=False)
+    for (tag, i1, i2, j1, j2) in sm.get_opcodes():
+        if tag == 'equal':
+            matched.extend(zip(range(i1, i2), range(j1, j2)))
+            continue
+        if tag in ('delete', 'replace'):
+            removed.extend(range(i1, i2))
+        if tag in ('insert', 'replace'):
+            inserted.extend(range(j1, j2))
+
+    return (removed, inserted, matched)
+
+def reconcile_playlist(api, executor, pl_name, pl_id, current, wanted):
+    '''Apply the smallest set of edits making a gm playlist match Banshee.
+
+    :param api: Google Music API connection
+    :param executor: MutationExecutor to make the changes with
+    :param pl_name: name of the playlist
+    :param pl_id: Google Music playlist id
+    :param current: list of (track key, entry id, song id) tuples
+    :param wanted: list of (track key, song id, song id) tuples
+
+    Entries not in the longest common sequence are removed and missing
+    songs are added.  If the API can reorder entries and some entries
+    stay in place, tracks that moved keep their entry and added tracks
+    are moved into position, front to back, each after the entry
+    before it and ahead of the next entry that stayed.  Otherwise songs
+    can only be appended, so everything from the first insertion on is
+    removed and added again.  Returns True if the playlist already
+    matched.
+    '''
+
+    (removed, inserted, matched) = playlist_edits([e[0] for e in current],
+                                                  [w[0] for w in wanted])
+    if not removed and not inserted:
+        return True
+
+    by_entry = hasattr(api, 'remove_entries_from_playlist')
+    # entries are placed relative to the ones that stay, so there must
+    # be some
+    reorder = (by_entry and hasattr(api, 'reorder_playlist_entry')
+               and bool(matched))
+    moved = {}
+    if reorder:
+        # pair removed and inserted copies of the same track into moves
+        pool = {}
+        for i in removed:
+            pool.setdefault(current[i][0], []).append(i)
+        for j in inserted:
+            if pool.get(wanted[j][0]):
+                moved[j] = pool[wanted[j][0]].pop(0)
+        kept = set(moved.itervalues())
+        removed = [i for i in removed if i not in kept]
+    else:
+        # rebuild the tail starting at the first insertion, or at the
+        # first kept copy of a song whose removal would take it along
+        first = len(wanted)
+        if inserted:
+            first = inserted[0]
+        while True:
+            tail = [i for (i, j) in matched if j >= first]
+            gone = set(current[i][2] for i in removed + tail)
+            if by_entry:
+                gone = set()
+            rebuild = [j for (i, j) in matched
+                       if j < first and current[i][2] in gone]
+            if not rebuild:
+                break
+            first = min(rebuild)
+        if first < len(wanted):
+            removed = sorted(removed + tail)
+            inserted = range(first, len(wanted))
+
+    logmsg('reconciling google music playlist {0}: {1} removed, {2} added, '
+           '{3} moved'.format(pl_name, len(removed),
+                              len(inserted) - len(moved), len(moved)))
+    if dryrun:
+        return False
+
+    # remove entries
+    if by_entry:
+        items = [(current[i][0], current[i][1], current[i][1])
+                 for i in removed]
+        (func, args) = (api.remove_entries_from_playlist, ())
+    else:
+        items = [(current[i][0], current[i][2], current[i][2])
+                 for i in removed]
+        (func, args) = (api.remove_songs_from_playlist, (pl_id,))
+    for batch in executor.batches(items):
+        for t_key in executor.call_batch(func, args, batch):
+            logmsg('failed to remove track from {0}: {1}'.format(
+                    pl_name, t_key), True)
+
+    # entry ids of the final playlist
+    entry_ids = [None] * len(wanted)
+    for (i, j) in matched:
+        entry_ids[j] = current[i][1]
+    for (j, i) in moved.iteritems():
+        entry_ids[j] = current[i][1]
+
+    # append new songs
+    added = [j for j in inserted if j not in moved]
+    for batch in executor.batches(added):
+        rv = executor.call(api.add_songs_to_playlist, pl_id,
+                           [wanted[j][1] for j in batch])
+        if not rv:
+            logmsg('failed to add tracks to {0}: {1}'.format(
+                    pl_name, ', '.join(wanted[j][0] for j in batch)), True)
+            continue
+        for (j, e) in zip(batch, rv):
+            if isinstance(e, (list, tuple)):
+                entry_ids[j] = e[1]
+
+    # move inserted entries into place front to back, so the entry
+    # before each one is already where it belongs
+    if reorder:
+        stayed = set(j for (i, j) in matched)
+        # next entry that stayed in place after each position
+        anchors = [None] * len(wanted)
+        nxt = None
+        for j in reversed(range(len(wanted))):
+            anchors[j] = nxt
+            if j in stayed:
+                nxt = {'id': entry_ids[j]}
+        prev = None
+        for j in range(len(wanted)):
+            if j in stayed:
+                prev = {'id': entry_ids[j]}
+                continue
+            if entry_ids[j] is None:
+                continue
+            if executor.call(api.reorder_playlist_entry, {'id': entry_ids[j]},
+                             prev, anchors[j]):
+                prev = {'id': entry_ids[j]}
+            else:
+                logmsg('failed to move track in {0}: {1}'.format(
+                        pl_name, wanted[j][0]), True)
+
+    return False
+
+def response_ids(rv):
+    '''Return list of song ids from a Google Music API mutation response.
+
+    :param rv: response from change_song_metadata, delete_songs, or
+               add_songs_to_playlist
+
+    Responses are lists of song ids, of (song id, entry id) tuples, or
+    of song dictionaries.
+    '''
+
+    if not isinstance(rv, (list, tuple)):
+        rv = [rv]
+    ids = []
+    for e in rv:
+        if isinstance(e, dict):
+            ids.append(e.get('id'))
+        elif isinstance(e, (list, tuple)):
+            ids.append(e[0])
+        else:
+            ids.append(e)
+    return ids
+
+class MutationPlan(object):
+    '''Google Music changes computed by track, playlist, or delete.
+
+    :param command: command that made the plan
+    :param items: list of changes
+
+    Each change is a list whose first element says what to do:
+
+    * ['metadata', track key, song dictionary, [hash, values]], where
+      the last element, if present, is remembered in the push ledger
+      once the change is made (see plan_track_updates)
+    * ['delete', track key, song id]
+    * ['create', playlist name]
+    * ['add', track key, song id, playlist name, playlist], where
+      playlist is the index of the item creating the playlist or the
+      id of an existing google music playlist
+    * ['reconcile', playlist name, playlist id, current, wanted], see
+      reconcile_playlist
+
+    Plans are stored as JSON so they can be looked over before they
+    are applied.
+    '''
 
-        # only look at local files
-        if not re_prefix.search(t['uri']):
-            continue
+    version = 1
 
-        # skip pdf files
-        if re_pdf.search(t['uri']):
-            continue
+    def __init__(self, command=None, items=None):
+        self.command = command
+        self.items = items or []
 
-        # check for know file types
-        if not re_mime.search(t['uri']):
-            logmsg('unknown file type: {0}'.format(t['uri']))
-            continue
+    def add(self, *item):
+        '''Append a change and return its index.'''
+        self.items.append(list(item))
+        return len(self.items) - 1
 
-        # looks like a real music track
-        tracks += 1
+    def save(self, filename):
+        '''Atomically write the plan to filename, returns True if successful.'''
 
-        # create dictionary key
-        key = make_track_key(t['track'], t['title'], t['album'], t['artist'])
+        doc = {'version': self.version, 'command': self.command,
+               'time': time.time(), 'items': self.items}
+        tmp = filename + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(doc, f)
+            os.rename(tmp, filename)
+        except (IOError, OSError) as e:
+            logmsg('unable to write plan {0}: {1}'.format(filename, e), True)
+            return False
+        logmsg('saved {0} google music changes to {1}'.format(
+                len(self.items), filename))
 
-        # see if track is a duplicate
-        if key in b_tracks:
-            if key in b_dups:
-                b_dups[key].append(t['uri'])
-            else:
-                b_dups[key] = [b_tracks[key]['uri'], t['uri']]
-        else:
-            b_tracks[key] = t
+        return True
 
-    # report metrics
-    logmsg('banshee rows: {0}'.format(rows))
-    logmsg('banshee tracks: {0}'.format(tracks))
-    logmsg("banshee dups: {0}".format(len(b_dups)))
-    logmsg("banshee unique tracks: {0}".format(len(b_tracks)))
+    @classmethod
+    def load(cls, filename):
+        '''Return the plan stored in filename, None if it cannot be read.'''
 
-    # write banshee dups
-    write_keys('b.dup', b_dups)
+        try:
+            with open(filename) as f:
+                doc = json.load(f)
+        except (IOError, ValueError) as e:
+            logmsg('unable to read plan {0}: {1}'.format(filename, e), True)
+            return None
+        if doc.get('version') != cls.version:
+            logmsg('plan was written by another version: {0}'.format(
+                    filename), True)
+            return None
+
+        return cls(doc['command'], doc['items'])
+
+class MutationJournal(object):
+    '''Append-only record of the plan items that have been applied.
+
+    :param filename: name of journal file, None to keep no journal
+
+    Every line is a JSON object holding the index of an item and its
+    result, or only the index when the item was started.  Lines are
+    synced to disk as they are written, so after a crash the journal
+    still lists every change that was made.  A line torn by the crash
+    is ignored when the journal is read back.
+    '''
 
-    return b_tracks
+    def __init__(self, filename=None):
+        self.done = {}
+        self.started = set()
+        self.lock = threading.Lock()
+        self.f = None
+        if not filename:
+            return
+        torn = False
+        if os.path.exists(filename):
+            with open(filename) as f:
+                for line in f:
+                    torn = not line.endswith('\n')
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if 'result' in entry:
+                        self.done[entry['item']] = entry['result']
+                    else:
+                        self.started.add(entry['item'])
+        self.f = open(filename, 'a')
+        if torn:
+            self.f.write('\n')
+
+    def write(self, entries):
+        '''Append entries to the journal and sync it to disk.'''
+
+        with self.lock:
+            for e in entries:
+                if 'result' in e:
+                    self.done[e['item']] = e['result']
+                else:
+                    self.started.add(e['item'])
+            if self.f:
+                self.f.write(''.join(json.dumps(e) + '\n' for e in entries))
+                self.f.flush()
+                os.fsync(self.f.fileno())
 
-def get_b_playlists(banshee_conn, playlists=[]):
-    '''Return dictionary of Banshee playlists.
+    def start(self, item):
+        '''Record that item is being applied.'''
+        self.write([{'item': item}])
 
-    :param banshee_conn: connection to Banshee database
-    :param playlists: playlists to return (return all if none specified)
+    def record(self, items, result=True):
+        '''Record that items were applied with result.'''
+        if items:
+            self.write([{'item': i, 'result': result} for i in items])
 
-    The dictionary has the names of the playlists as its keys and a
-    list of track keys (as generated by make_track_key) as its values.
+    def close(self):
+        if self.f:
+            self.f.close()
+            self.f = None
+
+def apply_plan(api, plan, executor=None, journal=None):
+    '''Make the changes of a plan, skipping those already applied.
+
+    :param api: Google Music API connection
+    :param plan: MutationPlan to apply
+    :param executor: MutationExecutor to make the changes with
+    :param journal: MutationJournal of changes already applied
+
+    Changes to songs are made batch_size at a time.  Each new playlist
+    is created and filled by a single task so the order of its tracks
+    is preserved; filling stops at the first batch that fails.  Every
+    change that succeeds is recorded in the journal (and metadata
+    changes in the push ledger); failed changes are not, so applying
+    the plan again retries them.  Returns True.
     '''
 
-    pl_to_get = []
-    # see if playlists were provided
-    if playlists:
-        # make sure they exist
-        for p_name in playlists:
-            banshee_c = banshee_conn.cursor()
-            t = (p_name,)
-            banshee_c.execute('select count(*) from CorePlayLists where Name = ?', t)
-            count = banshee_c.fetchone()[0]
-            if count == 0:
-                logmsg('banshee playlist does not exist: {0}'.format(p_name),
-                       True)
-                # need to check smart playlists
-            elif count > 1:
-                logmsg('multiple banshee playlists match: {0}'.format(p_name),
-                       True)
-            elif count == 1:
-                pl_to_get.append(p_name)
-            else:
-                logmsg('invalid count for playlist {0}: {1}'.format(p_name, count))
-                continue
-    else:
-        # get all playlists from banshee database
-        banshee_c = banshee_conn.cursor()
-        banshee_c.execute('select Name from CorePlaylists')
-        # put them in a list
-        pl_to_get = [row[0] for row in banshee_c.fetchall()]
+    if executor is None:
+        executor = MutationExecutor()
+    if journal is None:
+        journal = MutationJournal()
+
+    def push(func, args, batch, failure):
+        failed = set(executor.call_batch(func, args, batch))
+        for i in sorted(failed):
+            logmsg(failure.format(plan.items[i][1]), True)
+        done = [i for (i, v, song_id) in batch if i not in failed]
+        journal.record(done)
+        for i in done:
+            if plan.items[i][0] == 'delete':
+                logmsg('deleted track: {0} {1}'.format(
+                        plan.items[i][1], plan.items[i][2]), False, 'delete')
+        ledger.record([[plan.items[i][2]['id']] + plan.items[i][3]
+                       for i in done if plan.items[i][0] == 'metadata'
+                       and len(plan.items[i]) > 3])
+        return not failed
+
+    def fill(pl_name, pl_ref, adds):
+        pl_id = pl_ref
+        if isinstance(pl_ref, int):
+            pl_id = journal.done.get(pl_ref)
+            if pl_id is None:
+                pl_id = executor.call(api.create_playlist, pl_name)
+                if not pl_id:
+                    logmsg('failed to create playlist: {0}'.format(pl_name),
+                           True)
+                    return
+                journal.record([pl_ref], pl_id)
+        # add tracks to playlist in order, a limited number at a time
+        # to avoid big changes which confuse android google play music sync
+        for batch in executor.batches(adds):
+            for (i, song_id, s) in batch:
+                logmsg('adding track to {0}: {1}'.format(
+                        pl_name, plan.items[i][1]), False, 'playlist')
+            if not push(api.add_songs_to_playlist, (pl_id,), batch,
+                        u'failed to add track to ' + pl_name + u': {0}'):
+                # keep the order for when the plan is applied again
+                logmsg('stopped filling playlist: {0}'.format(pl_name), True)
+                return
+
+    def update(i, pl_name, pl_id, current, wanted):
+        if i in journal.started:
+            logmsg('reconciling {0} was interrupted, make a new plan for '
+                   'it'.format(pl_name), True)
+            return
+        if not dryrun:
+            journal.start(i)
+        if reconcile_playlist(api, executor, pl_name, pl_id, current, wanted):
+            logmsg('google music playlist up to date: {0}'.format(pl_name))
+        if not dryrun:
+            journal.record([i])
+
+    # sort out what is left to do
+    updates = []
+    removals = []
+    playlists = {}
+    reconciles = []
+    for (i, item) in enumerate(plan.items):
+        if i in journal.done:
+            continue
+        op = item[0]
+        if op == 'metadata':
+            updates.append((i, item[2], item[2]['id']))
+        elif op == 'delete':
+            removals.append((i, item[2], item[2]))
+        elif op == 'create':
+            playlists.setdefault(i, (item[1], []))
+        elif op == 'add':
+            playlists.setdefault(item[4], (item[3], []))[1].append(
+                (i, item[2], item[2]))
+        elif op == 'reconcile':
+            reconciles.append([i] + item[1:])
+        else:
+            logmsg('unknown change in plan: {0}'.format(op), True)
+    if journal.done:
+        logmsg('skipping {0} google music changes already made'.format(
+                len(journal.done)))
+
+    # bringing existing playlists up to date only reports in a dry run
+    for args in reconciles:
+        executor.submit(update, *args)
+    # !!! change a limited number of tracks at a time to avoid making big
+    # changes and crippling google music sync !!!
+    if not dryrun:
+        for batch in executor.batches(updates):
+            executor.submit(push, api.change_song_metadata, (), batch,
+                            u'failed to update metadata for track: {0}')
+        for batch in executor.batches(removals):
+            executor.submit(push, api.delete_songs, (), batch,
+                            u'failed to delete track: {0}')
+        for pl_ref in sorted(playlists):
+            (pl_name, adds) = playlists[pl_ref]
+            executor.submit(fill, pl_name, pl_ref, adds)
+
+    executor.join()
+    executor.report()
 
-    # loop through playlists
-    b_playlists = {}
-    for p_name in pl_to_get:
-        # get cursor for playlist query
-        banshee_p_c = banshee_conn.cursor()
-        t = (p_name,)
-        banshee_p_c.execute('''
-          select e.ViewOrder, a.Name, t.Title, t.TrackNumber, l.Title
-          from CoreTracks as t
-            join CoreArtists as a on t.ArtistID = a.ArtistID
-            join CoreAlbums as l on t.AlbumID = l.AlbumID
-            join CorePlaylistEntries as e on t.TrackID = e.TrackID
-            join CorePlaylists as p on e.PlaylistID = p.PlaylistID
-          where p.Name = ?
-          order by e.ViewOrder, e.EntryID''', t)
-
-        # loop through playlist tracks
-        b_playlists[p_name] = []
-        for trow in banshee_p_c:
-            (pn, artist, title, n, album) = trow
-            # create key
-            key = make_track_key(n, title, album, artist)
-            b_playlists[p_name].append(key)
+    return True
 
-    return b_playlists
+def run_plan(api, plan, executor=None, plan_file=None):
+    '''Apply a plan right away or save it to be applied later.
 
-def link_tracks(tracks, up=False):
-    """Create directory structure and hard link tracks in Banshee that need to be in Google Music.
+    :param api: Google Music API connection
+    :param plan: MutationPlan to apply
+    :param executor: MutationExecutor to make the changes with
+    :param plan_file: if set, save the plan in this file instead
+    '''
 
-    :param tracks: dictionary of track key,uri values
-    :param up: if true, create links in ~/Music/GoogleMusicUploads rather than ~/Music/GoogleMusic
+    if plan_file:
+        return plan.save(plan_file)
+    return apply_plan(api, plan, executor)
 
-    This method with create links for files in the tracks dictionary and
-    remove links for files not in it.  Return True if successful.
-    """
+# words that say nothing about which track it is
+fuzzy_stop_words = frozenset(['a', 'an', 'and', 'of', 'the', 'in', 'on', 'to',
+                              'feat', 'featuring', 'ft', 'with', 'vs'])
+re_featuring = re.compile(r'\s(feat|featuring|ft)\s.*$')
 
-    # set root paths
-    home = os.environ['HOME']
-    src_root = home + '/Music/Banshee'
-    target_root =  home + '/Music/GoogleMusic'
-    if up:
-        target_root = target_root + 'Uploads'
+def fuzzy_fields(key):
+    '''Return (number, title, album, artist) of a track key for matching.
 
-    # prepare regex
-    local_uri_re = re.compile('^file://')
-    src_root_re = re.compile('^' + src_root)
+    :param key: track key as generated by make_track_key
 
-    # dictionary for valid links
-    valid_links = {}
-    # iterate over items that need to be created
-    for (key, uri) in tracks.iteritems():
-        src = uri_to_path(uri)
-        if not src:
-            # uri_to_path will report the problem
-            continue
+    Featured artists are dropped from the title and artist.
+    '''
 
-        # initiate link path
-        link = src_root_re.sub(target_root, src)
-        # determine real paths (avoid sym link issues)
-        src_real = os.path.realpath(src)
-        link_real = os.path.realpath(link)
-        # store valid links for later pruning
-        valid_links[link_real] = 1
+    (n, title, album, artist) = key.split('|')
+    title = re_featuring.sub('', ' ' + title).strip()
+    artist = re_featuring.sub('', ' ' + artist).strip()
+    return (n, title, album, artist)
 
-        # see if link already exists
-        if os.path.exists(link_real):
-            continue
+def fuzzy_tokens(text):
+    '''Return set of words of text useful for blocking.'''
+    return set(w for w in text.split() if w not in fuzzy_stop_words)
 
-        # make sure source exists
-        if not os.path.exists(src_real):
-            logmsg(u'original file does not exist: {0}, {1}'.format(uri, src),
-                   True)
-            continue
+def fuzzy_duration(t, field):
+    '''Return duration of a track in seconds, None if unknown.'''
+    try:
+        return int(t.get(field)) / 1000.0
+    except (TypeError, ValueError):
+        return None
 
-        # create path to link
-        link_dir = os.path.dirname(link_real)
-        if not dryrun and not os.path.exists(link_dir):
-            if not mkpath(link_dir):
-                logmsg(u'failed to create dir: {0}'.format(link_dir), True)
-                continue
-        # create hard link
-        try:
-            if not dryrun:
-                os.link(src_real, link_real)
-        except OSError:
-            logmsg(u'failed to link: {0}, {1}'.format(src_real, link_real),
-                   True)
-            continue
+def fuzzy_match(gm_tracks, b_tracks, threshold=0.85, tolerance=3,
+                max_block=200):
+    '''Match Banshee tracks missing from gm_tracks to unmatched gm tracks.
 
-        logmsg(u"created link: {0}".format(link_real))
+    :param gm_tracks: dictionary of Google Music tracks
+    :param b_tracks: dictionary of Banshee tracks
+    :param threshold: minimum score (0-1) of an accepted match
+    :param tolerance: maximum difference in duration in seconds
+    :param max_block: words shared by more gm tracks are not used
+
+    Only tracks whose keys do not match exactly are considered.  The
+    unmatched gm tracks are indexed by the words of their artist and
+    album, so each Banshee track is only compared with gm tracks
+    sharing a reasonably rare word and having about the same duration.
+    Candidates are scored on title, artist, album, and track number
+    similarity, and each gm track is matched at most once, best
+    scores first.  All matches are written with their scores to
+    b-gm.fuzzy and a dictionary of Banshee key and gm key is returned.
+    '''
 
-    # remove unneeded files and directories
-    target_root_real = os.path.realpath(target_root)
-    # loop through all files
-    for (root, dirs, files) in os.walk(target_root_real):
-        # create full path
-        for f in files:
-            path = os.path.join(root, f)
-            # make sure it does not belong
-            if path in valid_links:
+    # unmatched tracks on both sides
+    b_left = [k for k in b_tracks if k not in gm_tracks]
+    gm_left = [k for k in gm_tracks if k not in b_tracks]
+    if not b_left or not gm_left:
+        return {}
+
+    # blocking index of unmatched gm tracks
+    gm_fields = {}
+    blocks = {}
+    for k in gm_left:
+        f = gm_fields[k] = fuzzy_fields(k)
+        for w in fuzzy_tokens(f[2]) | fuzzy_tokens(f[3]):
+            blocks.setdefault(w, []).append(k)
+
+    def ratio(a, b):
+        if a == b:
+            return 1.0
+        return difflib.SequenceMatcher(None, a, b).ratio()
+
+    # score candidates
+    scored = []
+    comparisons = 0
+    for b_key in b_left:
+        bf = fuzzy_fields(b_key)
+        b_dur = fuzzy_duration(b_tracks[b_key], 'duration')
+        candidates = set()
+        for w in fuzzy_tokens(bf[3]) or fuzzy_tokens(bf[2]):
+            block = blocks.get(w, ())
+            if len(block) <= max_block:
+                candidates.update(block)
+        for gm_key in candidates:
+            gm_dur = fuzzy_duration(gm_tracks[gm_key], 'durationMillis')
+            if (b_dur is not None and gm_dur is not None
+                and abs(b_dur - gm_dur) > tolerance):
                 continue
-            # rm the file
-            if not dryrun:
-                os.unlink(path)
-            logmsg("removed: {0}".format(path))
-
-    # loop again to find empty directories
-    for (root, dirs, files) in os.walk(target_root_real, topdown=False):
-        for d in dirs:
-            path = os.path.join(root, d)
-            if not os.listdir(path):
-                if not dryrun:
-                    os.rmdir(path)
-                logmsg(u"removed empty directory: {0}".format(path))
+            gf = gm_fields[gm_key]
+            comparisons += 1
+            score = (0.5 * ratio(bf[1], gf[1]) + 0.25 * ratio(bf[3], gf[3])
+                     + 0.15 * ratio(bf[2], gf[2]) + 0.1 * (bf[0] == gf[0]))
+            if score >= threshold:
+                scored.append((score, b_key, gm_key))
+
+    # best matches first, using each track once
+    matches = {}
+    used = set()
+    report = {}
+    for (score, b_key, gm_key) in sorted(scored, reverse=True):
+        if b_key in matches or gm_key in used:
+            continue
+        matches[b_key] = gm_key
+        used.add(gm_key)
+        report[u'{0:.3f}\t{1}\t{2}'.format(score, b_key, gm_key)] = 1
 
-    return True
+    logmsg('fuzzy comparisons: {0}, matches: {1} of {2} unmatched tracks'
+           .format(comparisons, len(matches), len(b_left)))
+    write_keys('b-gm.fuzzy', report)
+
+    return matches
 
 # above are the helper methods
 # below are the task-oriented methods
 
-def diff(gm_tracks, b_tracks):
+def diff(gm_tracks, b_tracks, verify=False):
     """Create directory structure for Banshee tracks not in Google Music.
 
     :param gm_tracks: dictionary of Google Music entries
     :param b_tracks: dictionary of Banshee tracks
+    :param verify: if true, check the whole directory (see link_tracks)
 
     The directory structure will be under ~/Music/GoogleMusicUploads.
     """
@@ -543,12 +3092,13 @@ def diff(gm_tracks, b_tracks):
     write_keys('b-gm.up', no_gm)
 
     # create directory suitable for google music manager
-    return link_tracks(no_gm, True)
+    return link_tracks(no_gm, True, verify)
 
-def sync(b_tracks):
+def sync(b_tracks, verify=False):
     """Create directory structure for Banshee tracks for Google Music.
 
     :param b_tracks: dictionary of Banshee tracks
+    :param verify: if true, check the whole directory (see link_tracks)
 
     The directory structure will be under ~/Music/GoogleMusic.
     """
@@ -562,51 +3112,126 @@ def sync(b_tracks):
     write_keys('b-gm.sync', b_uri)
 
     # create directory suitable for google music manager
-    return link_tracks(b_uri)
+    return link_tracks(b_uri, False, verify)
 
-def fs(b_tracks):
-    '''Report discrepancies between Banshee database and file system.
+def walk_files(root):
+    '''Return list of paths of all files below root.
 
-    :param b_tracks: dictionary of Banshee tracks
+    :param root: directory to walk
 
-    This method is not perfect because b_tracks, as generated by
-    get_b_library, only considers songs with ratings.  In other words,
-    tracks with NULL ratings will appear as discrepancies.
+    The top-level directories are walked concurrently, using jobs
+    threads.  The listings are kept in path_cache.
     '''
 
-    # loop through banshee tracks
+    if not os.path.isdir(root):
+        return []
+
+    def walk(path):
+        files = []
+        for (name, p, is_dir) in path_cache.list_dir(path):
+            if is_dir:
+                files.extend(walk(p))
+            else:
+                files.append(p)
+        return files
+
+    files = []
+    dirs = []
+    for (name, p, is_dir) in path_cache.list_dir(root):
+        if is_dir:
+            dirs.append(p)
+        else:
+            files.append(p)
+
+    if jobs > 1 and len(dirs) > 1:
+        pool = ThreadPool(jobs)
+        listings = pool.map(walk, dirs)
+        pool.close()
+        pool.join()
+    else:
+        listings = map(walk, dirs)
+    for listing in listings:
+        files.extend(listing)
+
+    return files
+
+def fs(banshee_conn, full=False):
+    '''Report discrepancies between Banshee database and file system.
+
+    :param banshee_conn: connection to Banshee database
+    :param full: if True, ignore the saved Banshee track index
+
+    Every local (file://) track in the Banshee database is considered,
+    regardless of rating.  The existence checks and the walk of
+    ~/Music/Banshee are spread over jobs threads and the two sides are
+    compared as sets.  The walk comes first so the checks of the
+    tracks in ~/Music/Banshee are answered from its listings (see
+    PathCache).
+    '''
+
+    # walk through the file system
+    b_root = music_dir() + '/Banshee'
+    b_root_real = path_cache.real_dir(b_root)
+    with metrics.span('fs_walk'):
+        fs_files = walk_files(b_root_real)
+
+    # get all local banshee tracks
+    index = None
+    if not full:
+        index = load_snapshot(b_fs_index_file)
+    index = refresh_b_index(banshee_conn, index)
+    save_snapshot(b_fs_index_file, index)
+    local = []
+    for track_id in sorted(index['rows']):
+        entry = index['rows'][track_id]
+        if entry is None or not entry[0]['uri'].startswith('file://'):
+            continue
+        local.append(entry)
+
+    # see which tracks exist
+    def check(entry):
+        t_path = uri_to_path(entry[0]['uri'])
+        if not path_cache.exists(t_path):
+            return (entry, t_path, None)
+        return (entry, t_path, path_cache.real_path(t_path))
+
+    if jobs > 1:
+        pool = ThreadPool(jobs)
+        checked = pool.map(check, local, 64)
+        pool.close()
+        pool.join()
+    else:
+        checked = map(check, local)
+
     b_missing = {}
     b_valid = {}
-    for (key, t) in b_tracks.iteritems():
+    for ((t, key), t_path, t_path_real) in checked:
         uri = t['uri']
-        t_path = uri_to_path(uri)
-        if not os.path.exists(t_path):
+        if t_path_real is None:
             logmsg(u'track does not exist: {0}, {1}'.format(uri, t_path), True)
+            if not key:
+                key = make_track_key(t['track'], t['title'], t['album'],
+                                     t['artist'])
             b_missing[key] = uri
             continue
         # else store for later
-        t_path_real = os.path.realpath(t_path)
         b_valid[t_path_real] = uri
 
-    # walk through the file system
-    fs_extra = {}
-    fs_skipped = {}
-    b_root = os.environ['HOME'] + '/Music/Banshee'
-    b_root_real = os.path.realpath(b_root)
+    # sort out the files found
     re_music = re.compile('\.(flac|m4a|mp3|ogg)$', re.I)
-    for (root, dirs, files) in os.walk(b_root_real):
-        # just interested in the files
-        for f in files:
-            # create full path
-            path = os.path.join(root, f)
-            # skip non-music files
-            if not re_music.search(f):
-                fs_skipped[path] = 1
-                continue
-            # make sure it does not belong
-            if path not in b_valid:
-                logmsg(u'extra track: {0}'.format(path), True)
-                fs_extra[path] = 1
+    fs_music = set()
+    fs_skipped = {}
+    for path in fs_files:
+        # skip non-music files
+        if re_music.search(path):
+            fs_music.add(path)
+        else:
+            fs_skipped[path] = 1
+
+    # find music files that do not belong
+    fs_extra = dict.fromkeys(fs_music.difference(b_valid), 1)
+    for path in sorted(fs_extra):
+        logmsg(u'extra track: {0}'.format(path), True)
 
     # write the missing and extra tracks
     write_keys('b-missing.fs', b_missing)
@@ -616,16 +3241,62 @@ def fs(b_tracks):
 
     return True
 
-def track(api, gm_tracks, b_tracks, elements):
+def track(api, gm_tracks, b_tracks, elements, executor=None, plan_file=None,
+          full=False):
     '''Update Google Music track metadata using information from Banshee database.
 
     :param api: Google Music API connection
     :param gm_tracks: Google Music track dictionary
     :param b_tracks: Banshee track dictionary
+    :param elements: list of track elements to update
+    :param executor: MutationExecutor to make the changes with
+    :param plan_file: save the changes in this file instead of making them
+    :param full: if True, compare tracks unchanged since their last push
+
+    This method returns True if successful.  See parse_track_elements
+    for the elements it can update.  What was pushed is remembered in
+    the push ledger, so tracks whose Banshee values did not change
+    are skipped and play counts can be summed on every run.
+    '''
+
+    update_k = parse_track_elements(elements)
+    if not update_k:
+        return False
+
+    pushed = ledger.load()
+    if full:
+        # keep the values play counts are summed from
+        pushed = dict((i, (None, v)) for (i, (h, v)) in pushed.iteritems())
+    settled = []
+    plan = plan_track_updates(gm_tracks, b_tracks, update_k, pushed, settled)
+    ledger.record(settled)
+
+    return run_plan(api, plan, executor, plan_file)
+
+def track_push_hasher(update_k):
+    '''Return function hashing the update elements and the values they push.
+
+    :param update_k: elements to update as returned by parse_track_elements
+
+    The returned function takes a dictionary of the Banshee values of
+    the update elements and returns the hash as a string.
+    '''
+
+    fields = sorted(update_k)
+    spec = repr([(k, update_k[k]) for k in fields])
+
+    def push_hash(values):
+        return hashlib.sha1(
+            spec + repr([values[k] for k in fields])).hexdigest()
+
+    return push_hash
+
+def parse_track_elements(elements):
+    '''Return dictionary of track elements to update and their directives.
+
     :param elements: list of track elements to update
 
-    This method returns True if successful.  The possible elements it
-    can update are:
+    The possible elements are:
 
     * rating
     * albumArtist
@@ -640,8 +3311,8 @@ def track(api, gm_tracks, b_tracks, elements):
     Any update element can have ":f" appended to force it to overwrite
     existing information.  Otherwise, it will only update empty
     fields.  The playCount element can have ":sum" appended to
-    indicate the play counts from Banshee and Google Music should be
-    added; implies force.
+    indicate the plays in Banshee since the last push should be added
+    to the Google Music play count; implies force.
     '''
 
     # see what we should do
@@ -677,72 +3348,272 @@ def track(api, gm_tracks, b_tracks, elements):
     if not update_k:
         logmsg('no valid metadata elements provided, valid: {0}'.format(
                 allowed_k), True)
-        return False
+
+    return update_k
+
+@gc_paused
+def plan_track_updates(gm_tracks, b_tracks, update_k, pushed=None,
+                       settled=None):
+    '''Return MutationPlan updating Google Music tracks from Banshee.
+
+    :param gm_tracks: Google Music track dictionary
+    :param b_tracks: Banshee track dictionary
+    :param update_k: elements to update as returned by parse_track_elements
+    :param pushed: dictionary of song id and (hash, values) tuples of
+                   earlier pushes as returned by PushLedger.load
+    :param settled: if given, (song id, hash, values) tuples of the
+                    tracks needing no change are appended to this list
+
+    Tracks whose hash (see track_push_hasher) is the same as when they
+    were last pushed are skipped.  Summed play counts only add the
+    plays since the last push.  Every metadata change carries the
+    hash and values to remember once it is made.  The tracks are
+    compared by track_changes, sharded on track key (see shard_map).
+    '''
+
+    if pushed is None:
+        pushed = {}
 
     # loop through banshee tracks
+    fields = sorted(update_k)
+    (b_values, gm_values) = (BansheeTrack.getter(fields),
+                             GMTrack.getter(fields))
+    keys = []
+    ids = []
+    rows = []
     for (key, b_track) in b_tracks.iteritems():
         # see if tracks is in google music
-        if key not in gm_tracks:
+        gm_track = gm_tracks.get(key)
+        if gm_track is None:
             logmsg('banshee track not in google music: {0}'.format(key), True)
             continue
+        (last_h, values) = pushed.get(gm_track['id'], (None, {}))
+        rows.append((len(keys), b_values(b_track), gm_values(gm_track),
+                     last_h, values))
+        keys.append(key)
+        ids.append(gm_track['id'])
+
+    # compare them, putting the changes back in banshee order
+    unchanged = 0
+    changed = []
+    for (part, (n, tracks)) in shard_map(track_changes, rows,
+                                         lambda row: keys[row[0]], update_k,
+                                         settled is not None):
+        unchanged += n
+        changed.extend(tracks)
+    changed.sort(key=lambda t: t[0])
+
+    plan = MutationPlan('track')
+    for (i, h, values, changes) in changed:
+        if not changes:
+            settled.append((ids[i], h, values))
+            continue
 
-        # create updated track dictionary
-        update = {}
-        no_update = True
-        # copy unchanged elements
-        for (gm_k, gm_v) in gm_tracks[key].iteritems():
-            # by default, make no change
-            update[gm_k] = gm_v
-            # see if this element is to be updated
-            if gm_k in update_k:
-                # make sure element of b_track contains something
-                if not b_track[gm_k]:
-                    continue
-                # see if value is already set
-                if gm_v and not update_k[gm_k]:
-                    # not forcing
-                    continue
-                # else, check for play count summing
-                if gm_k == 'playCount' and update_k[gm_k] == 'sum':
-                    update[gm_k] = b_track[gm_k] + gm_v
-                # make sure element of b_track contains something
-                else:
-                    update[gm_k] = b_track[gm_k]
-                # record that an update occurred
-                no_update = False
+        # update google music track metadata
+        key = keys[i]
+        logmsg('updating metadata for track: {0}'.format(key), False, 'track')
+        update = gm_tracks[key].to_dict()
+        update.update(changes)
+        plan.add('metadata', key, update, [h, values])
+
+    if pushed:
+        logmsg('tracks unchanged since last push: {0}'.format(unchanged))
+
+    return plan
+
+def track_changes(rows, update_k, keep_settled=False):
+    '''Work out the changes to push to tracks (see plan_track_updates).
+
+    :param rows: list of (index, Banshee values, Google Music values,
+                 last hash, last values) tuples, the values being in the
+                 order of sorted(update_k) and the last hash and values
+                 being those of PushLedger.load
+    :param update_k: elements to update as returned by parse_track_elements
+    :param keep_settled: if True, also return tracks needing no change
+
+    A tuple of the number of tracks unchanged since their last push
+    and a list of (index, hash, values, changes) tuples is returned,
+    values being the Banshee values to remember and changes the
+    dictionary of elements to update.  Summed play counts are added
+    to the larger of the Google Music count and the total last pushed
+    (kept in the values under ledger_gm_total), since the Google Music
+    library may come from a snapshot taken before that push.
+    '''
+
+    fields = sorted(update_k)
+    push_hash = track_push_hasher(update_k)
+    unchanged = 0
+    tracks = []
+    for (i, b_values, gm_values, last_h, values) in rows:
+        # skip tracks that did not change since they were last pushed
+        current = dict(zip(fields, b_values))
+        h = push_hash(current)
+        if h == last_h:
+            unchanged += 1
+            continue
+
+        # work out the changed elements
+        changes = {}
+        for (gm_k, b_v, gm_v) in zip(fields, b_values, gm_values):
+            d = update_k[gm_k]
+            # check for play count summing
+            if gm_k == 'playCount' and d == 'sum':
+                # only add the plays since the last push, to the total
+                # last pushed if the gm count is older than that push
+                b_v = (b_v or 0) - (values.get(gm_k) or 0)
+                if b_v > 0:
+                    changes[gm_k] = b_v + max(gm_v or 0,
+                                              values.get(ledger_gm_total) or 0)
+                continue
+            # make sure element of b_track contains something
+            if not b_v:
+                continue
+            # see if value is already set
+            if gm_v and not d:
+                # not forcing
+                continue
+            # no need to push what is already there
+            if b_v != gm_v:
+                changes[gm_k] = b_v
 
         # see if an update was recorded
-        if no_update:
+        if not changes and not keep_settled:
             continue
 
-        # update google music track metadata
-        # !!! update tracks one at a time to avoid making big changes and
-        # crippling google music sync !!!
-        logmsg('updating metadata for track: {0}'.format(key))
-        if not dryrun:
-            updated = api.change_song_metadata(update)
-            if not updated:
-                logmsg('failed to update metadata for track: {0}'.format(key),
-                       True)
-            # wait a bit to avoid appearance of denial of service
-            time.sleep(2)
+        # remember the values pushed
+        values = dict(values)
+        values.update(current)
+        if 'playCount' in changes and update_k['playCount'] == 'sum':
+            values[ledger_gm_total] = changes['playCount']
+        tracks.append((i, h, values, changes))
+
+    return (unchanged, tracks)
+
+def watch(api, gm_tracks, banshee_conn, rating, elements, executor=None,
+          wait=10.0, poll=1.0):
+    '''Push changes of Banshee tracks to Google Music as they happen.
+
+    :param api: Google Music API connection
+    :param gm_tracks: Google Music track dictionary
+    :param banshee_conn: connection to Banshee database
+    :param rating: minimum rating of tracks to push
+    :param elements: list of track elements to update (see
+                     parse_track_elements), by default rating:f and,
+                     with a push ledger, playCount:sum
+    :param executor: MutationExecutor to make the changes with
+    :param wait: push once the database has not changed for this
+                 many seconds
+    :param poll: check the database this often (seconds)
+
+    The modification times of the Banshee database and its write-ahead
+    log are polled.  After a burst of changes settles, the tracks that
+    changed are read (see refresh_b_index) and their differences with
+    the in-memory google music library are pushed like the track
+    command does, remembering them in the push ledger.  The first
+    round pushes every difference.  Tracks whose update failed are
+    tried again when the database changes next.  Songs added to google
+    music while watching are not seen.  Runs until interrupted.
+    '''
+
+    # forcing play counts would throw away plays made on other devices
+    if not elements:
+        elements = ['rating:f']
+        if ledger.filename:
+            elements.append('playCount:sum')
+    update_k = parse_track_elements(elements)
+    if not update_k:
+        return False
+    if update_k.get('playCount') == 'sum' and not ledger.filename:
+        logmsg('watch cannot sum play counts without a push ledger, they '
+               'would be added every time the track changes', True)
+        return False
+    if executor is None:
+        executor = MutationExecutor()
+
+    db = banshee_conn.execute('pragma database_list').fetchone()[2]
+
+    def signature():
+        sig = []
+        for path in (db, db + '-wal'):
+            try:
+                st = os.stat(path)
+            except OSError:
+                sig.append(None)
+                continue
+            sig.append((st.st_mtime, st.st_size))
+        return sig
+
+    index = load_snapshot(b_index_file)
+    # Banshee tracks as google music has them
+    synced = {}
+    last = signature()
+    changed_at = time.time() - wait
+    pending = True
+    logmsg('watching for changes: {0}'.format(db))
+    try:
+        while True:
+            if pending and time.time() - changed_at >= wait:
+                pending = False
+                with metrics.span('watch_push'):
+                    index = refresh_b_index(banshee_conn, index, rating)
+                    save_snapshot(b_index_file, index)
+                    changed = dict(
+                        (k, t) for (k, t)
+                        in select_b_tracks(index, rating, False).iteritems()
+                        if synced.get(k) != t)
+                    logmsg('banshee tracks changed: {0}'.format(len(changed)))
+                    settled = []
+                    plan = plan_track_updates(gm_tracks, changed, update_k,
+                                              ledger.load(), settled)
+                    ledger.record(settled)
+                    journal = MutationJournal()
+                    apply_plan(api, plan, executor, journal)
+                    # remember what google music has now
+                    failed = set()
+                    for (i, item) in enumerate(plan.items):
+                        if i in journal.done:
+                            gm_tracks[item[1]] = GMTrack(item[2])
+                        elif not dryrun:
+                            failed.add(item[1])
+                    for (k, t) in changed.iteritems():
+                        if k not in failed:
+                            synced[k] = t
+            time.sleep(poll)
+            sig = signature()
+            if sig != last:
+                last = sig
+                changed_at = time.time()
+                pending = True
+    except KeyboardInterrupt:
+        logmsg('stopped watching: {0}'.format(db))
 
     return True
 
-def playlist(api, gm_tracks, b_playlists):
+def playlist(api, gm_tracks, b_playlists, executor=None, reconcile=False,
+             plan_file=None):
     '''Create Banshee playlists in Google Music.
 
     :param api: Google Music API connection
     :param gm_tracks: dictionary of Google Music tracks
     :param b_playlists: dictionary of Banshee playlists to upload
+    :param executor: MutationExecutor to make the changes with
+    :param reconcile: if True, update existing playlists rather than
+                      skipping them (see reconcile_playlist)
+    :param plan_file: save the changes in this file instead of making them
+
+    Each Google Music playlist is filled by a single task so the
+    order of its tracks is preserved, while separate playlists may be
+    filled concurrently (see apply_plan).
     '''
 
+    plan = MutationPlan('playlist')
+
     # get google music playlists
-    gm_playlists = get_gm_playlists(api)
+    gm_playlists = get_gm_playlists(api, reconcile)
 
     # loop through banshee playlists
     for (playlist_name, tracks) in b_playlists.iteritems():
-        if playlist_name in gm_playlists:
+        if playlist_name in gm_playlists and not reconcile:
             logmsg('banshee playlist already exists as google music playlist: '
                    + '{0}'.format(playlist_name), True)
             continue
@@ -756,12 +3627,13 @@ def playlist(api, gm_tracks, b_playlists):
             if t_count > 0:
                 pl_name = playlist_name + str(int(t_count / pl_track_max))
             # create playlist
-            logmsg('creating google music playlist: {0}'.format(pl_name))
-            if not dryrun:
-                playlist_id = api.create_playlist(pl_name)
+            exists = pl_name in gm_playlists
+            if not exists:
+                logmsg('creating google music playlist: {0}'.format(pl_name))
 
             # loop through songs
             pl_tracks = 0
+            entries = []
             while t_count < len(tracks):
                 t_key = tracks[t_count]
                 # count all the tracks
@@ -778,16 +3650,13 @@ def playlist(api, gm_tracks, b_playlists):
                     logmsg('google music track has no id: {0}, {1}'.format(
                             pl_name, t_key), True)
                     continue
- 
-                # add track to playlist (order is preserved)
-                # add one track at a time to avoid big changes which confuse
-                # android google play music sync
-                logmsg('adding track to {0}: {1}'.format(pl_name, t_key))
-                if not dryrun:
-                    api.add_songs_to_playlist(playlist_id,
-                                              gm_tracks[t_key]['id'])
-                    # wait a bit to avoid appearnce of denial of service
-                    time.sleep(2)
+
+                # queue track for adding
+                if dryrun and not exists:
+                    logmsg('adding track to {0}: {1}'.format(pl_name, t_key),
+                           False, 'playlist')
+                track_id = gm_tracks[t_key]['id']
+                entries.append((t_key, track_id, track_id))
 
                 # count all added tracks
                 pl_tracks += 1
@@ -798,12 +3667,62 @@ def playlist(api, gm_tracks, b_playlists):
                     logmsg('playlist full, incrementing: {0}'.format(pl_name))
                     break
 
-    return True
+            # bring existing playlist up to date
+            if exists and reconcile:
+                (pl_id, current) = gm_playlists[pl_name]
+                plan.add('reconcile', pl_name, pl_id, current, entries)
+            elif exists:
+                logmsg('banshee playlist already exists as google music '
+                       'playlist: {0}'.format(pl_name), True)
+            # create and fill playlist
+            else:
+                pl_ref = plan.add('create', pl_name)
+                for (t_key, track_id, i) in entries:
+                    plan.add('add', t_key, track_id, pl_name, pl_ref)
 
+    return run_plan(api, plan, executor, plan_file)
+
+@gc_paused
 def validate(gm_tracks):
     '''Loop through all gm track metadata and check for bad stuff.
 
-    :param gm_tracks: gm tracks dictionary as generated by get_gm_library
+    :param gm_tracks: gm song dictionaries as generated by get_gm_library
+                      with full
+
+    The tracks are checked by metadata_problems, sharded on track key
+    (see shard_map).
+    '''
+
+    keys = []
+    rows = []
+    for (key, gm_dict) in gm_tracks.iteritems():
+        rows.append((len(keys), gm_dict.items()))
+        keys.append(key)
+
+    problems = []
+    for (part, found) in shard_map(metadata_problems, rows,
+                                   lambda row: keys[row[0]]):
+        problems.extend(found)
+    problems.sort(key=lambda p: p[0])
+
+    for (i, gm_k, kind) in problems:
+        key = keys[i]
+        if kind:
+            logmsg(u'google track metadata not expected type: {0}: {1}={2}'.format(key, gm_k, kind), True)
+        else:
+            logmsg(u'google track with non-printable metadata: {0}: {1}'.format(key, gm_k), True)
+
+    return True
+
+def metadata_problems(rows):
+    '''Return the problems of Google Music track metadata (see validate).
+
+    :param rows: list of (index, items) tuples, items being the
+                 (field, value) pairs of a song dictionary
+
+    A list of (index, field, kind) tuples is returned, kind being the
+    type of a value that is not a string or number, or None for a
+    string with non-printable characters.
     '''
 
     # non-printable characters regex
@@ -813,26 +3732,29 @@ def validate(gm_tracks):
     re_control_char = re.compile('[{0}]'.format(re.escape(control_chars)))
 
     # look through tracks
-    for (key, gm_dict) in gm_tracks.iteritems():
-        # loop through track dictionary
-        for (gm_k, gm_v) in gm_dict.iteritems():
+    problems = []
+    for (i, items) in rows:
+        # loop through track metadata
+        for (gm_k, gm_v) in items:
             # int and bool types should not cause a problem (right?)
             if type(gm_v) is int or type(gm_v) is bool:
                 continue
             # else make sure it is a string
             if not isinstance(gm_v, basestring):
-                logmsg(u'google track metadata not expected type: {0}: {1}={2}'.format(key, gm_k, type(gm_v)), True)
+                problems.append((i, gm_k, str(type(gm_v))))
             elif re_control_char.search(gm_v):
-                    logmsg(u'google track with non-printable metadata: {0}: {1}'.format(key, gm_k), True)
+                problems.append((i, gm_k, None))
 
-    return True
+    return problems
 
-def delete(api, gm_tracks, b_playlists):
+def delete(api, gm_tracks, b_playlists, executor=None, plan_file=None):
     '''Delete tracks on Banshee playlists from Google Music.
 
     :param api: Google Music API connection
     :param gm_tracks: dictionary of Google Music tracks
     :param b_playlists: dictionary of Banshee playlists to upload
+    :param executor: MutationExecutor to make the changes with
+    :param plan_file: save the changes in this file instead of making them
 
     This method will only remove tracks that do not have the storeID
     element, indicating they were free/purchased.
@@ -874,25 +3796,26 @@ def delete(api, gm_tracks, b_playlists):
                 continue
 
             # delete the track
-            # !!! delete tracks one at a time to avoid making big changes and
-            # crippling google music sync !!!
-            if not dryrun:
-                api.delete_songs(track_id)
-                # wait a bit to avoid appearance of denial of service
-                time.sleep(2)
-            logmsg('deleted track: {0} {1}'.format(t_key, track_id))
+            logmsg('deleting track: {0} {1}'.format(t_key, track_id), False,
+                   'delete')
             deleted_tracks[t_key] = track_id
 
+    plan = MutationPlan('delete')
+    for (t_key, track_id) in sorted(deleted_tracks.iteritems()):
+        plan.add('delete', t_key, track_id)
+    rv = run_plan(api, plan, executor, plan_file)
+
     write_keys('gm.missing', missing_tracks)
     write_keys('gm.deleted', deleted_tracks)
     write_keys('gm.store', store_tracks)
 
-    return True
+    return rv
 
 def dump(gm_tracks, keys):
     '''Print out the dictionary for some track.
 
-    :param gm_tracks: gm tracks dictionary as generated by get_gm_library
+    :param gm_tracks: gm song dictionaries as generated by get_gm_library
+                      with full
     :param keys: keys of tracks to be dumped
     '''
 
@@ -905,6 +3828,284 @@ def dump(gm_tracks, keys):
 
     return True
 
+def apply_file(api, args, executor=None):
+    '''Make the changes saved in a plan file.
+
+    :param api: Google Music API connection
+    :param args: list holding the name of the plan file
+    :param executor: MutationExecutor to make the changes with
+
+    Changes that were made are appended to the journal, the plan file
+    name with .journal appended, so applying the plan again after an
+    interruption picks up where the last attempt stopped.
+    '''
+
+    if len(args) != 1:
+        logmsg('apply needs the name of a plan file', True)
+        return False
+    plan = MutationPlan.load(args[0])
+    if not plan:
+        return False
+    journal = MutationJournal(args[0] + '.journal')
+    try:
+        rv = apply_plan(api, plan, executor, journal)
+    finally:
+        journal.close()
+    logmsg('{0} of {1} google music changes made'.format(
+            len(journal.done), len(plan.items)))
+
+    return rv and len(journal.done) == len(plan.items)
+
+def run_info(conn, run):
+    '''Return a description of a run in the report database.'''
+
+    row = conn.execute('select time, command from runs where id = ?',
+                       (run,)).fetchone()
+    if not row:
+        return None
+    return u'{0} ({1} {2})'.format(
+        run, row[1], datetime.fromtimestamp(row[0]).strftime('%Y-%m-%d %H:%M'))
+
+def changes(report, runs):
+    '''Print keys that differ between two runs.
+
+    :param report: RunReport holding the runs
+    :param runs: ids of the runs to compare; by default the latest
+                 run is compared with the run of the same command
+                 before it
+    :returns: True if the runs could be compared
+
+    Only categories recorded by both runs are compared.  Keys only in
+    the later run are printed with a +, keys only in the earlier run
+    with a -.
+    '''
+
+    conn = report.connect()
+    try:
+        runs = [int(r) for r in runs]
+        if len(runs) < 2:
+            if runs:
+                run_b = runs[0]
+            else:
+                run_b = conn.execute('select max(id) from runs').fetchone()[0]
+            row = conn.execute('''select max(id) from runs where id < ? and
+                command = (select command from runs where id = ?)''',
+                               (run_b, run_b)).fetchone()
+            runs = [row[0], run_b]
+        (run_a, run_b) = runs[:2]
+        for run in runs:
+            if run is None or not run_info(conn, run):
+                logmsg('no such run to compare: {0}'.format(run), True)
+                return False
+        logmsg(u'comparing run {0} with run {1}'.format(
+                run_info(conn, run_a), run_info(conn, run_b)))
+
+        both = '''category in (select category from categories where run = ?)
+                  and category in (select category from categories where run = ?)'''
+        query = '''select category, key from keys where run = ? and {0}
+                   except
+                   select category, key from keys where run = ?
+                   order by category, key'''.format(both)
+        added = conn.execute(query, (run_b, run_a, run_b, run_a)).fetchall()
+        removed = conn.execute(query, (run_a, run_a, run_b, run_b)).fetchall()
+    except ValueError:
+        logmsg('runs must be given by number: {0}'.format(' '.join(runs)),
+               True)
+        return False
+    finally:
+        conn.close()
+
+    for (sign, rows) in (('-', removed), ('+', added)):
+        for (category, key) in rows:
+            print u'{0} {1}: {2}'.format(sign, category, key)
+    logmsg('keys added: {0}, removed: {1}'.format(len(added), len(removed)))
+
+    return True
+
+def export(report, runs):
+    '''Write the reports of a run to flat files named after them.
+
+    :param report: RunReport holding the runs
+    :param runs: id of the run to export, by default the latest run
+    :returns: True if the run was exported
+    '''
+
+    conn = report.connect()
+    try:
+        if runs:
+            run = int(runs[0])
+        else:
+            run = conn.execute('select max(id) from runs').fetchone()[0]
+        info = run_info(conn, run)
+        if not info:
+            logmsg('no such run to export: {0}'.format(run), True)
+            return False
+        categories = [c for (c,) in conn.execute(
+                'select category from categories where run = ?', (run,))]
+        for category in categories:
+            keys = conn.execute('''select key from keys
+                where run = ? and category = ?''', (run, category))
+            write_flat_keys(category, (k for (k,) in keys))
+    except ValueError:
+        logmsg('run must be given by number: {0}'.format(runs[0]), True)
+        return False
+    finally:
+        conn.close()
+    logmsg(u'exported run {0}: {1}'.format(info, ', '.join(sorted(categories))))
+
+    return True
+
+def gm_credentials(options):
+    '''Return google email and password, prompting for what is missing.
+
+    :param options: command line options
+
+    The email comes from --email and the password from the first line
+    of --password-file or from the environment variable named by
+    password_env.
+    '''
+
+    email = options.email
+    if not email:
+        email = raw_input("Email: ")
+    password = os.environ.get(password_env)
+    if options.password_file:
+        with open(options.password_file) as f:
+            password = f.readline().rstrip('\n')
+    if password is None:
+        password = getpass()
+
+    return (email, password)
+
+def run_profile(name, cmd, directory):
+    '''Run banshee-gm in a separate process for a profile.
+
+    :param name: name of the profile
+    :param cmd: command line to run
+    :param directory: working directory of the run
+
+    Output goes to banshee-gm.out in directory.  A tuple of the
+    profile name, exit status, duration in seconds, and a dictionary
+    of the report categories and key counts recorded by the run is
+    returned.
+    '''
+
+    mkpath(directory)
+    start = time.time()
+    with open(os.path.join(directory, pkg + '.out'), 'w') as out:
+        with open(os.devnull) as null:
+            status = subprocess.call(cmd, cwd=directory, stdin=null,
+                                     stdout=out, stderr=subprocess.STDOUT)
+    duration = time.time() - start
+
+    # look up what the run reported
+    counts = {}
+    db = os.path.join(directory, report_db_file)
+    if os.path.exists(db):
+        conn = sqlite3.connect(db)
+        try:
+            counts = dict(conn.execute('''select category, count
+                from categories where run =
+                  (select max(id) from runs where time >= ?)''', (start,)))
+        except sqlite3.Error:
+            pass
+        finally:
+            conn.close()
+
+    return (name, status, duration, counts)
+
+def run_profiles(filename, argv):
+    '''Run banshee-gm for every profile in a configuration file at once.
+
+    :param filename: name of profile configuration file
+    :param argv: command line options and command for every profile
+
+    Each section of the file is a profile, with these settings (any
+    of which may be given in the DEFAULT section):
+
+    * banshee_db: Banshee database (default ~/.config/banshee-1/banshee.db)
+    * email: google account
+    * password_file: file holding the google password (otherwise the
+      password is taken from the environment variable password_env)
+    * music_root: directory holding the Banshee and GoogleMusic
+      directories (default ~/Music)
+    * directory: working directory for log, report, and snapshot
+      files (default the profile name)
+    * options: extra command line options for the profile
+    * command: command and arguments, if not given on the command line
+
+    Every profile runs in its own process and all of them run at
+    the same time.  A summary of the runs is logged.  Returns True if
+    every run succeeded.
+    '''
+
+    config = ConfigParser.SafeConfigParser()
+    if not config.read(filename):
+        logmsg('unable to read profiles: {0}'.format(filename), True)
+        return False
+
+    script = os.path.abspath(__file__)
+    if script.endswith('.pyc'):
+        script = script[:-1]
+    runs = []
+    for name in config.sections():
+        def setting(key, default=None):
+            if config.has_option(name, key):
+                return config.get(name, key)
+            return default
+
+        cmd = [sys.executable, script] + argv + ['-q']
+        if setting('banshee_db'):
+            cmd += ['-b', os.path.abspath(os.path.expanduser(
+                        setting('banshee_db')))]
+        if not setting('email'):
+            logmsg('profile has no email: {0}'.format(name), True)
+            continue
+        cmd += ['--email', setting('email')]
+        if setting('password_file'):
+            cmd += ['--password-file', os.path.abspath(os.path.expanduser(
+                        setting('password_file')))]
+        elif password_env not in os.environ:
+            logmsg('profile has no password_file and {0} is not set: '
+                   '{1}'.format(password_env, name), True)
+            continue
+        if setting('music_root'):
+            cmd += ['--music-root', os.path.abspath(os.path.expanduser(
+                        setting('music_root')))]
+        cmd += shlex.split(setting('options', ''))
+        cmd += shlex.split(setting('command', ''))
+        directory = os.path.abspath(os.path.expanduser(
+                setting('directory', name)))
+        runs.append((name, cmd, directory))
+
+    if not runs:
+        logmsg('no profiles to run: {0}'.format(filename), True)
+        return False
+
+    logmsg('running profiles: {0}'.format(', '.join(r[0] for r in runs)))
+    start = time.time()
+    # the threads only wait for the processes doing the work
+    pool = ThreadPool(len(runs))
+    try:
+        results = pool.map(lambda run: run_profile(*run), runs)
+    finally:
+        pool.close()
+
+    # summarize
+    failed = 0
+    for (name, status, duration, counts) in results:
+        if status:
+            failed += 1
+        logmsg(u'profile {0}: {1} in {2:.1f}s{3}'.format(
+                name, 'failed' if status else 'ok', duration,
+                ''.join(u', {0} {1}'.format(c, n)
+                        for (c, n) in sorted(counts.iteritems()))))
+    logmsg('profiles: {0} ok, {1} failed, {2:.1f}s (longest {3:.1f}s)'.format(
+            len(results) - failed, failed, time.time() - start,
+            max(r[2] for r in results)))
+
+    return not failed and len(runs) == len(config.sections())
+
 def main(argv):
     '''Farm out work to task-based methods.
 
@@ -915,12 +4116,18 @@ def main(argv):
     usage = """%prog [OPTIONS]... [COMMAND] [ARGS]...
        %prog [OPTIONS]... diff
        %prog [OPTIONS]... sync
-       %prog [OPTIONS]... fs (not working)
+       %prog [OPTIONS]... fs
        %prog [OPTIONS]... track UPDATE_KEYS[...]
        %prog [OPTIONS]... playlist [PLAYLIST]...
        %prog [OPTIONS]... delete [PLAYLIST]...
+       %prog [OPTIONS]... apply PLAN
+       %prog [OPTIONS]... watch [UPDATE_KEYS]...
+       %prog [OPTIONS]... index [drop]
        %prog [OPTIONS]... validate
-       %prog [OPTIONS]... dump TRACK_KEY[...]"""
+       %prog [OPTIONS]... dump TRACK_KEY[...]
+       %prog [OPTIONS]... changes [RUN_A [RUN_B]]
+       %prog [OPTIONS]... export [RUN]
+       %prog [OPTIONS]... --profiles FILE [COMMAND] [ARGS]..."""
     version_str = "{0} {1}".format(pkg, __version__)
     parser = OptionParser(usage=usage, version=version_str)
     # default banshee database
@@ -928,24 +4135,94 @@ def main(argv):
     banshee_db_help = "use Banshee database BANSHEE_DB (default {0})".format(banshee_db_def)
     parser.add_option("-b", "--banshee-db", default=banshee_db_def,
                       help=banshee_db_help)
+    parser.add_option("--copy-db", action="store_true", default=False,
+                      help="read a private copy of the Banshee database ({0})".format(b_copy_file))
     parser.add_option("-d", "--dry-run", action="store_true", default=False,
                       help="perform no action, just report what would be done")
+    parser.add_option("-e", "--email",
+                      help="log in to google as EMAIL instead of asking")
+    parser.add_option("--password-file", metavar="FILE",
+                      help="read the google password from FILE instead of asking (also see {0})".format(password_env))
+    parser.add_option("-j", "--jobs", type="int", default=1,
+                      help="use JOBS threads for file system work (default 1)")
+    parser.add_option("--shards", type="int", default=1,
+                      help="compare large libraries in SHARDS processes (default 1)")
+    parser.add_option("--flat-files", action="store_true", default=False,
+                      help="also write reports to flat files as well as {0}".format(report_db_file))
+    parser.add_option("--fuzzy", type="float", metavar="SCORE",
+                      help="treat Banshee and google music tracks whose keys differ as the same if their similarity is at least SCORE (0-1)")
+    parser.add_option("-f", "--full", action="store_true", default=False,
+                      help="ignore saved library snapshots and load everything, compare tracks unchanged since their last push")
+    parser.add_option("--music-root", metavar="DIR",
+                      help="directory holding the Banshee and GoogleMusic directories (default ~/Music)")
+    parser.add_option("-m", "--max-age", type="int", metavar="SECONDS",
+                      help="reuse google music library snapshot younger than SECONDS without contacting google")
+    parser.add_option("-p", "--plan", metavar="FILE",
+                      help="save the google music changes track, playlist, and delete would make in FILE instead of making them (see apply)")
     parser.add_option("-q", "--quiet", action="store_true",
                       help="do not print status messages")
+    parser.add_option("-l", "--log-level", action="append", default=[],
+                      metavar="[CATEGORY=]LEVEL",
+                      help="only record messages of at least LEVEL ({0}), optionally just for CATEGORY ({1}); may be repeated".format(
+            ', '.join(sorted(log_levels, key=log_levels.get)),
+            ', '.join(log_categories)))
+    parser.add_option("--profile", action="store_true", default=False,
+                      help="profile the run and log the hot spots")
+    parser.add_option("--profiles", metavar="FILE",
+                      help="run for each profile in FILE at the same time (see run_profiles)")
+    parser.add_option("--trace-malloc", action="store_true", default=False,
+                      help="trace memory allocations and log the biggest allocators")
     # default minimum rating
     rating_def = 3
     rating_help = "only consider Banshee songs with rating >= RATING (default {0})".format(rating_def)
     parser.add_option("-r", "--rating", type="int", default=rating_def,
                       help=rating_help)
-
-    (options, args) = parser.parse_args()
+    parser.add_option("-w", "--wait", type="float", default=10.0,
+                      help="in watch mode, push changes once Banshee has been quiet for WAIT seconds (default 10)")
+    parser.add_option("--verify", action="store_true", default=False,
+                      help="check every staged link and the whole staging directory instead of trusting the manifest (diff and sync)")
+    parser.add_option("--reconcile", action="store_true", default=False,
+                      help="update existing google music playlists instead of skipping them")
+    parser.add_option("--batch-size", type="int", default=25,
+                      help="change at most BATCH_SIZE google music songs per call (default 25)")
+    parser.add_option("-c", "--concurrency", type="int", default=1,
+                      help="make at most CONCURRENCY google music changes at once (default 1)")
+    parser.add_option("--rate", type="float", default=0.5,
+                      help="make at most RATE google music changes per second (default 0.5)")
+
+    (options, args) = parser.parse_args(argv[1:])
     # set "globals"
-    global dryrun
+    global dryrun, jobs, shards, music_root
     dryrun = options.dry_run
+    jobs = options.jobs
+    shards = options.shards
+    music_root = options.music_root
     logmsg.quiet = options.quiet
-
-    # open log file
-    logmsg.log_f = codecs.open(pkg + '.log', mode='w', encoding='utf-8')
+    for setting in options.log_level:
+        (category, sep, level) = setting.rpartition('=')
+        if level not in log_levels or (sep and category not in log_categories):
+            parser.error('invalid log level: {0}'.format(setting))
+        logmsg.levels[category or None] = log_levels[level]
+
+    # open log file, making sure it is written out however we exit
+    logmsg.log_f = LogWriter(pkg + '.log')
+    atexit.register(logmsg.log_f.close)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+
+    # run every profile with the rest of the command line
+    if options.profiles:
+        rest = []
+        skip = False
+        for arg in argv[1:]:
+            if skip:
+                skip = False
+            elif arg == '--profiles':
+                skip = True
+            elif not arg.startswith('--profiles='):
+                rest.append(arg)
+        if run_profiles(options.profiles, rest):
+            sys.exit(0)
+        sys.exit(1)
 
     # determine action
     command = 'diff'
@@ -954,72 +4231,162 @@ def main(argv):
         # save the rest
         args = args[1:]
 
+    # record where the time goes (last registered runs first at exit)
+    metrics.info = {'command': command, 'args': args, 'version': __version__}
+    atexit.register(metrics.write, pkg + '.metrics')
+    instrument_syscalls()
+    start_profiling(options.profile, options.trace_malloc)
+
+    # keep reports in the report database
+    report.filename = report_db_file
+    report.flat = options.flat_files
+    # remember what track pushes
+    ledger.filename = push_ledger_file
+
+    # commands looking at earlier runs need nothing else
+    if command in ('changes', 'export'):
+        with metrics.span(command):
+            if command == 'changes':
+                rv = changes(report, args)
+            else:
+                rv = export(report, args)
+        if rv:
+            sys.exit(0)
+        sys.exit(1)
+
+    # adding the banshee index needs neither gm nor a read-only connection
+    if command == 'index':
+        with metrics.span(command):
+            rv = index_banshee(options.banshee_db, args)
+        if rv:
+            sys.exit(0)
+        sys.exit(1)
+
     # log in to Google Music (gm)
-    api = Api() 
+    api = InstrumentedApi(Api())
 
     gm_tracks = {}
     # sync and fs do not need connection to gm
     if command != 'sync' and command != 'fs':
-        logged_in = False
-        attempts = 0
-        while not logged_in and attempts < 3:
-            email = raw_input("Email: ")
-            password = getpass()
-
-            logged_in = api.login(email, password)
-            attempts += 1
-
-        if not api.is_authenticated():
-            logmsg('google credentials were not accepted', True)
-            return
-
-        logmsg("successfully logged in to google")
-
-        # get the google music library
-        gm_tracks = get_gm_library(api)
-
-    # connect to banshee database
-    banshee_conn = sqlite3.connect(options.banshee_db)
-    if not banshee_conn:
-        logmsg('unable to connect to banshee: {0}'.format(options.banshee_db),
-               True)
-        return
-
-    # get the banshee library
-    b_tracks = get_b_library(banshee_conn, options.rating)
+        # see if a recent enough copy of the library is around
+        snapshot = None
+        if not options.full and command != 'apply':
+            snapshot = load_snapshot(gm_snapshot_file)
+
+        # commands that only read the library need not log in if it is
+        if (command not in ('diff', 'validate', 'dump')
+            or not gm_snapshot_fresh(snapshot, options.max_age)):
+            logged_in = False
+            attempts = 0
+            # only ask again if there is someone to ask
+            tries = 3
+            if options.email and (options.password_file
+                                  or password_env in os.environ):
+                tries = 1
+            while not logged_in and attempts < tries:
+                (email, password) = gm_credentials(options)
+
+                with metrics.span('login'):
+                    logged_in = api.login(email, password)
+                attempts += 1
+
+            if not api.is_authenticated():
+                logmsg('google credentials were not accepted', True)
+                sys.exit(1)
+
+            logmsg("successfully logged in to google")
+
+        # get the google music library (a plan knows what to change)
+        if command != 'apply':
+            # validate and dump look at every field, not just GMTrack's
+            with metrics.span('gm_library'):
+                gm_tracks = get_gm_library(api, snapshot, options.max_age,
+                                           command in ('validate', 'dump'))
+
+    # connect to banshee database, never writing to it
+    if options.copy_db and command == 'watch':
+        logmsg('watch cannot read a copy of the banshee database', True)
+        sys.exit(1)
+    try:
+        banshee_conn = connect_banshee(options.banshee_db,
+                                       options.copy_db and b_copy_file)
+    except (sqlite3.Error, EnvironmentError) as e:
+        logmsg('unable to connect to banshee: {0}: {1}'.format(
+                options.banshee_db, e), True)
+        sys.exit(1)
+
+    # get the banshee library (fs looks at all tracks itself) and
+    # playlists from the same snapshot of the database
+    b_tracks = {}
+    b_playlists = {}
+    if command not in ('fs', 'apply', 'watch'):
+        with read_transaction(banshee_conn):
+            with metrics.span('b_library'):
+                b_tracks = get_b_library(banshee_conn, options.rating,
+                                         options.full)
+            if command in ('playlist', 'delete'):
+                # keys of known tracks by TrackID
+                track_keys = dict((t['id'], key)
+                                  for (key, t) in b_tracks.iteritems())
+                with metrics.span('b_playlists'):
+                    b_playlists = get_b_playlists(banshee_conn, args,
+                                                  track_keys)
+    # match tracks whose keys disagree
+    if options.fuzzy and command in ('diff', 'track', 'playlist', 'delete'):
+        gm_tracks = dict(gm_tracks)
+        with metrics.span('fuzzy_match'):
+            matches = fuzzy_match(gm_tracks, b_tracks, options.fuzzy)
+        for (b_key, gm_key) in matches.iteritems():
+            gm_tracks[b_key] = gm_tracks[gm_key]
+
+    # pace changes to google music
+    executor = MutationExecutor(options.rate, options.concurrency,
+                                batch_size=options.batch_size)
 
     # dispatch
     rv = 0
-    if command == 'diff':
-        # create files not in google music
-        rv = diff(gm_tracks, b_tracks)
-    elif command == 'sync':
-        # create all files with sufficient rating
-        rv = sync(b_tracks)
-    elif command == 'fs':
-        # check banshee database and file system for consistency
-        rv = fs(b_tracks)
-    elif command == 'track':
-        # update track metadata
-        rv = track(api, gm_tracks, b_tracks, args)
-    elif command == 'playlist':
-        # get banshee playlists
-        b_playlists = get_b_playlists(banshee_conn, args)
-        # upload banshee playlists to google music
-        rv = playlist(api, gm_tracks, b_playlists)
-    elif command == 'validate':
-        # make sure the gm track metadata does not have bad characters
-        rv = validate(gm_tracks)
-    elif command == 'delete':
-        # get banshee playlists
-        b_playlists = get_b_playlists(banshee_conn, args)
-        # delete tracks on banshee playlists from google music
-        rv = delete(api, gm_tracks, b_playlists)
-    elif command == 'dump':
-        rv = dump(gm_tracks, args)
-    else:
-        logmsg('unknown command: {0}'.format(command), True)
-        return
+    with metrics.span(command):
+        if command == 'diff':
+            # create files not in google music
+            rv = diff(gm_tracks, b_tracks, options.verify)
+        elif command == 'sync':
+            # create all files with sufficient rating
+            rv = sync(b_tracks, options.verify)
+        elif command == 'fs':
+            # check banshee database and file system for consistency
+            rv = fs(banshee_conn, options.full)
+        elif command == 'track':
+            # update track metadata
+            rv = track(api, gm_tracks, b_tracks, args, executor, options.plan,
+                       options.full)
+        elif command == 'playlist':
+            # upload banshee playlists to google music
+            rv = playlist(api, gm_tracks, b_playlists, executor,
+                          options.reconcile, options.plan)
+        elif command == 'validate':
+            # make sure the gm track metadata does not have bad characters
+            rv = validate(gm_tracks)
+        elif command == 'delete':
+            # delete tracks on banshee playlists from google music
+            rv = delete(api, gm_tracks, b_playlists, executor, options.plan)
+        elif command == 'watch':
+            # keep pushing track changes
+            rv = watch(api, gm_tracks, banshee_conn, options.rating, args,
+                       executor, options.wait)
+        elif command == 'apply':
+            # make the changes saved by --plan
+            rv = apply_file(api, args, executor)
+        elif command == 'dump':
+            rv = dump(gm_tracks, args)
+        else:
+            logmsg('unknown command: {0}'.format(command), True)
+            sys.exit(1)
+
+    # record the reports of this run
+    with metrics.span('report'):
+        run = report.save(command, args)
+    if run:
+        logmsg('recorded run {0} in {1}'.format(run, report_db_file))
 
     # logout of gm
     api.logout()
@@ -1027,9 +4394,7 @@ def main(argv):
     # disconnect from banshee database
     banshee_conn.close()
 
-    # close log file
-    logmsg.log_f.close
-
+    # the log file is closed at exit, after the profiling reports
     if rv:
         sys.exit(0)
     # else
@@ -0,0 +1,140 @@
+#! /usr/bin/env python
+# tests for banshee-gm.py, run offline against the benchmark's FakeApi
+
+import imp
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+bench = imp.load_source('banshee_gm_bench',
+                        os.path.join(here, 'banshee-gm-bench.py'))
+bgm = bench.load_banshee_gm(os.path.join(here, 'banshee-gm.py'))
+bgm.logmsg.quiet = True
+
+class AppendApi(bench.FakeApi):
+    '''FakeApi that can only append songs and remove them by song id.'''
+
+    def remove_songs_from_playlist(self, playlist_id, song_ids):
+        self.call('remove_songs_from_playlist')
+        songs = self.playlists[playlist_id]['songs']
+        songs[:] = [t for t in songs if t['id'] not in song_ids]
+        return song_ids
+
+class ReorderApi(bench.FakeApi):
+    '''FakeApi that removes and reorders playlist entries.'''
+
+    def remove_entries_from_playlist(self, entry_ids):
+        self.call('remove_entries_from_playlist')
+        for p in self.playlists.itervalues():
+            p['songs'][:] = [t for t in p['songs']
+                             if t['playlistEntryId'] not in entry_ids]
+        return entry_ids
+
+    def reorder_playlist_entry(self, entry, to_follow=None, to_precede=None):
+        self.call('reorder_playlist_entry')
+        for p in self.playlists.itervalues():
+            songs = p['songs']
+            ids = [e['playlistEntryId'] for e in songs]
+            if entry['id'] not in ids:
+                continue
+            moved = songs.pop(ids.index(entry['id']))
+            ids = [e['playlistEntryId'] for e in songs]
+            if to_follow:
+                songs.insert(ids.index(to_follow['id']) + 1, moved)
+            elif to_precede:
+                songs.insert(ids.index(to_precede['id']), moved)
+            else:
+                songs.append(moved)
+            return entry
+        return None
+
+class ReconcilePlaylistTest(unittest.TestCase):
+    '''reconcile_playlist leaves google music playlists in wanted order.'''
+
+    cases = 3000
+
+    def reconcile(self, api_class, current, wanted):
+        api = api_class()
+        api.playlists = {}
+        pl_id = api.create_playlist(u'mix')
+        entries = api.add_songs_to_playlist(pl_id, [u'song-' + k
+                                                    for k in current])
+        before = [(k, e, s) for (k, (s, e)) in zip(current, entries)]
+        after = [(k, u'song-' + k, u'song-' + k) for k in wanted]
+        executor = bgm.MutationExecutor(rate=1e6)
+        bgm.reconcile_playlist(api, executor, u'mix', pl_id, before, after)
+        return [t['id'][5:] for t in api.playlists[pl_id]['songs']]
+
+    def check(self, api_class):
+        rand = random.Random(0)
+        keys = u'abcdefghij'
+        for n in range(self.cases):
+            current = [rand.choice(keys) for i in range(rand.randint(0, 8))]
+            wanted = [rand.choice(keys) for i in range(rand.randint(0, 8))]
+            self.assertEqual(self.reconcile(api_class, current, wanted),
+                             wanted, 'case {0}: {1} -> {2}'.format(
+                    n, current, wanted))
+
+    def test_append(self):
+        self.check(AppendApi)
+
+    def test_reorder(self):
+        self.check(ReorderApi)
+
+    def test_reorder_examples(self):
+        for (current, wanted) in [(u'ceg', u'gec'),
+                                  (u'gfhjgb', u'fihgjgb')]:
+            self.assertEqual(self.reconcile(ReorderApi, list(current),
+                                            list(wanted)), list(wanted))
+
+class PlaylistTest(unittest.TestCase):
+    '''playlist only touches existing google music playlists to reconcile.'''
+
+    def test_existing_part_skipped(self):
+        api = bench.FakeApi()
+        api.playlists = {u'playlist-0': {'name': u'mix1', 'songs': [
+                    {'id': u'song-{0}'.format(i), 'playlistEntryId': i,
+                     'title': u'', 'album': u'', 'artist': u''}
+                    for i in range(3)]}}
+        keys = [u'key {0}'.format(i) for i in range(1001)]
+        gm_tracks = dict((k, {'id': u'song-{0}'.format(i)})
+                         for (i, k) in enumerate(keys))
+        executor = bgm.MutationExecutor(rate=1e6)
+        bgm.playlist(api, gm_tracks, {u'mix': keys}, executor)
+        sizes = dict((p['name'], len(p['songs']))
+                     for p in api.playlists.itervalues())
+        self.assertEqual(sizes, {u'mix': 1000, u'mix1': 3})
+
+class SnapshotTest(unittest.TestCase):
+    '''The library snapshot gives back complete song dictionaries.'''
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def test_full_songs(self):
+        api = bench.FakeApi()
+        api.songs = [{'id': u'song-{0}'.format(i), 'title': u'title',
+                      'album': u'album', 'artist': u'artist', 'track': i,
+                      'rating': None, 'url': u'//song/{0}'.format(i),
+                      'lastModifiedTimestamp': unicode(i + 1)}
+                     for i in range(5)]
+        bgm.get_gm_library(api)
+        snapshot = bgm.load_snapshot(bgm.gm_snapshot_file)
+        gm_tracks = bgm.get_gm_library(api, snapshot, 3600, True)
+        self.assertEqual(sorted(gm_tracks.itervalues(), key=lambda t: t['id']),
+                         api.songs)
+        self.assertTrue(all(isinstance(t, bgm.GMTrack)
+                            for t in bgm.get_gm_library(
+                        api, snapshot, 3600).itervalues()))
+
+if __name__ == '__main__':
+    unittest.main()